@@ -0,0 +1,681 @@
+"""
+Benchmarks of the labeling hot paths on synthetic data
+
+Synthetic corpus is speech-like .wav files with matching recognised text fragments,
+so no VOSK model, punctuation model or network is needed
+
+Run `python benchmark.py` (all benchmarks) or e.g. `python benchmark.py stages --sizes 2 8 32`
+"""
+import io
+import os
+import math
+import time
+import zlib
+import types
+import random
+import argparse
+import tempfile
+import contextlib
+
+import pydub
+import numpy as np
+import pandas as pd
+
+import settings
+from utils.audio_utils import detect_leading_silence, detect_silence, normalization_gains, read_wav, write_wav, \
+    slice_samples
+from utils.text_cleaners import english_cleaner_series
+from utils.transcripts import save_transcript, load_transcript
+from utils.utils import dataset_stat
+from utils.profiling import Profiler
+
+SCRIPT_DATA_PATH = os.path.join('data', 'script')  # text fragments used to synthesize audio (.json)
+
+
+def synthetic_clips(n_clips, sample_rate=22050, min_time=1.0, max_time=8.0, seed=0):
+    """
+    Speech-like clips: noise bursts with a varying envelope and quiet margins in the beginning and the end
+
+    :return: list of np.int16 arrays
+    """
+    rng = np.random.default_rng(seed)
+    clips = []
+    for _ in range(n_clips):
+        n = int(rng.uniform(min_time, max_time) * sample_rate)
+        envelope = np.repeat(rng.uniform(0.2, 1.0, n // 1000 + 1), 1000)[:n]
+        margin_start, margin_end = rng.integers(0, sample_rate // 4, 2)
+        envelope[:margin_start] = 0.005
+        envelope[n - margin_end:] = 0.005
+        clips.append((rng.standard_normal(n) * envelope * 5000).astype(np.int16))
+    return clips
+
+
+class StubTokenizer:
+    """
+    Stand-in for the wordpiece tokenizer of recasepunc: words are split into pieces of 4 characters
+    """
+
+    def tokenize(self, text):
+        tokens = []
+        for word in text.split():
+            tokens.append(word[:4])
+            tokens.extend(['##' + word[i:i + 4] for i in range(4, len(word), 4)])
+        return tokens
+
+    def convert_tokens_to_ids(self, tokens):
+        return [{'[CLS]': 101, '[SEP]': 102}.get(token, zlib.crc32(token.encode('utf8')) % 30000 + 1000)
+                for token in tokens]
+
+
+class StubCasePuncPredictor:
+    """
+    Stand-in for recasepunc.CasePuncPredictor: tokenize adds [CLS] and [SEP] to wordpieces of the text,
+    predict skips them and gives deterministic labels
+    """
+
+    def __init__(self, max_length=256, overlap=20):
+        self.config = types.SimpleNamespace(max_length=max_length, overlap=overlap, tokenizer=StubTokenizer(),
+                                            cls_token='[CLS]', sep_token='[SEP]', cls_token_id=101, sep_token_id=102,
+                                            device='cpu')
+
+    def tokenize(self, text):
+        return [self.config.cls_token] + self.config.tokenizer.tokenize(text) + [self.config.sep_token]
+
+    def predict(self, tokens, getter=lambda x: x):
+        ids = self.config.tokenizer.convert_tokens_to_ids([getter(token) for token in tokens])
+        for i, (id_, token) in enumerate(zip(ids, tokens)):
+            if id_ != self.config.cls_token_id and id_ != self.config.sep_token_id:
+                yield token, 'UPPER' if i % 7 == 0 else 'LOWER', 'PERIOD' if i % 11 == 0 else 'O'
+
+    def map_case_label(self, token, case_label):
+        return token.upper() if case_label == 'UPPER' else token
+
+    def map_punc_label(self, token, punc_label):
+        token = token[2:] if token.startswith('##') else token
+        return token + '.' if punc_label == 'PERIOD' else token
+
+
+class TorchCasePuncPredictor(StubCasePuncPredictor):
+    """
+    Stand-in for recasepunc.CasePuncPredictor with a small transformer of the same inputs and outputs,
+    so batches and torch threads cost like a real model (labels are not meaningful)
+    """
+
+    def __init__(self, max_length=256, overlap=20, d_model=256, n_layers=4, seed=0):
+        import torch
+
+        super().__init__(max_length, overlap)
+        torch.manual_seed(seed)
+        self.rev_case = {0: 'LOWER', 1: 'UPPER', 2: 'CAPITALIZE', 3: 'OTHER'}
+        self.rev_punc = {0: 'O', 1: 'PERIOD', 2: 'COMMA', 3: 'QUESTION', 4: 'EXCLAMATION'}
+
+        class Model(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.embedding = torch.nn.Embedding(31000, d_model)
+                layer = torch.nn.TransformerEncoderLayer(d_model, 4, 4 * d_model, batch_first=True)
+                self.encoder = torch.nn.TransformerEncoder(layer, n_layers)
+                self.punc = torch.nn.Linear(d_model, 5)
+                self.case = torch.nn.Linear(d_model, 4)
+
+            def forward(self, x):
+                h = self.encoder(self.embedding(x))
+                return self.punc(h), self.case(h)
+
+        self.model = Model().eval()
+
+    def predict(self, tokens, getter=lambda x: x):
+        """
+        Windows as recasepunc.CasePuncPredictor.predict: tokens with [CLS] and [SEP] are cut into windows
+        of max_length tokens overlapping by overlap tokens and padded with id 0, the first window reaching
+        the end of tokens is the last one
+        """
+        import torch
+
+        max_length, overlap = self.config.max_length, self.config.overlap
+        for start in range(0, len(tokens), max_length - overlap):
+            window = tokens[start:start + max_length]
+            ids = self.config.tokenizer.convert_tokens_to_ids([getter(token) for token in window])
+            ids += [0] * (max_length - len(ids))
+            with torch.no_grad():
+                punc_scores, case_scores = self.model(torch.tensor([ids]).long().to(self.config.device))
+            punc_labels = torch.max(punc_scores, 2)[1][0].tolist()
+            case_labels = torch.max(case_scores, 2)[1][0].tolist()
+            for i, (id_, token) in enumerate(zip(ids, window)):
+                if id_ == self.config.cls_token_id or id_ == self.config.sep_token_id or (start > 0 and i < overlap):
+                    continue
+                yield token, self.rev_case[case_labels[i]], self.rev_punc[punc_labels[i]]
+            if start + max_length > len(tokens):
+                return
+
+
+def torch_punctuation_predictor(model_class):
+    """
+    Subclass of models.PunctuationPredictor (model_class) with TorchCasePuncPredictor
+    """
+    class TorchPunctuationPredictor(model_class):
+        def __init__(self, dir_model=None, lang='en', model=None, threads=None):
+            super().__init__(lang=lang, model=TorchCasePuncPredictor(), threads=threads)
+
+    return TorchPunctuationPredictor
+
+
+def synthetic_transcript(n_words, seed=0):
+    """
+    Vosk-like .json data with n_words words in fragments of 1-12 words
+    """
+    rng = random.Random(seed)
+    vocabulary = ['w%dx%s' % (i, 'abc' * rng.randint(0, 4)) for i in range(5000)]
+    json_data = []
+    time_ = 0.0
+    while n_words > 0:
+        words = []
+        for _ in range(min(rng.randint(1, 12), n_words)):
+            words.append({'conf': 1.0, 'end': round(time_ + 0.3, 2), 'start': round(time_, 2),
+                          'word': rng.choice(vocabulary)})
+            time_ += 0.4
+        n_words -= len(words)
+        json_data.append({'result': words, 'text': ' '.join([word['word'] for word in words])})
+        time_ += 0.5
+    return json_data
+
+
+def benchmark_punctuation_restore(n_words=100000):
+    """
+    Rebuild words of a long transcript from predicted token labels (model time is excluded)
+    """
+    from models import PunctuationPredictor
+
+    punc_predictor = PunctuationPredictor(model=StubCasePuncPredictor())
+    json_data = synthetic_transcript(n_words)
+    predictions = list(punc_predictor.model.predict(punc_predictor._tokenize(json_data), lambda x: x[1]))
+
+    t = time.perf_counter()
+    punc_predictor._restore(json_data, punc_predictor._tokenize(json_data), predictions)
+    print('punctuation restore, %d words: %.2f sec' % (n_words, time.perf_counter() - t))
+
+
+def benchmark_split(n_clips=2000000, n_sources=20000):
+    """
+    Train, val, test split of a large metadata by source files and by clips, balanced by duration
+    """
+    from utils.split import split_by_duration
+
+    rng = np.random.default_rng(0)
+    durations = rng.uniform(settings.MIN_TIME, settings.MAX_TIME, n_clips)
+    paths = pd.Series(['data/input/file%05d.wav' % i for i in range(n_sources)]).iloc[
+        rng.integers(0, n_sources, n_clips)].reset_index(drop=True)
+    fractions = [settings.TRAIN_FRAC, settings.VAL_FRAC, settings.TEST_FRAC]
+
+    t = time.perf_counter()
+    groups, _ = pd.factorize(paths)
+    subsets = split_by_duration(durations, fractions, groups)
+    source_time = time.perf_counter() - t
+    t = time.perf_counter()
+    split_by_duration(durations, fractions)
+    clip_time = time.perf_counter() - t
+
+    shares = ', '.join(['%.4f' % (np.sum(durations[subsets == i]) / np.sum(durations))
+                        for i in range(len(fractions))])
+    print('split, %d clips: by %d sources %.2f sec (duration shares %s), by clips %.2f sec'
+          % (n_clips, n_sources, source_time, shares, clip_time))
+
+
+def benchmark_silence_trimming(n_clips=2000, sample_rate=22050):
+    """
+    detect_leading_silence on the sample and its reversed copy vs detect_silence
+    """
+    clips = synthetic_clips(n_clips, sample_rate)
+    segments = [pydub.AudioSegment(clip.tobytes(), frame_rate=sample_rate, sample_width=2, channels=1)
+                for clip in clips]
+
+    t = time.perf_counter()
+    reference = [(detect_leading_silence(s), detect_leading_silence(s.reverse())) for s in segments]
+    reference_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    result = [detect_silence(clip, sample_rate) for clip in clips]
+    result_time = time.perf_counter() - t
+
+    assert reference == result
+    print('silence trimming, %d clips: detect_leading_silence %.2f sec, detect_silence %.2f sec, speedup x%.1f'
+          % (n_clips, reference_time, result_time, reference_time / result_time))
+
+
+_syllables = ['ba', 'ko', 'ri', 'te', 'nu', 'sa', 'mel', 'dor', 'vin', 'cha', 'lo', 'pe', 'st', 'gra']
+_vocabulary = [''.join(random.Random(i).choices(_syllables, k=1 + i % 4)) for i in range(3000)] + \
+              ['mr', 'dr', 'st', "don't", 'well-known']
+
+
+def synthetic_script(duration, seed=0):
+    """
+    Vosk-like .json data for `duration` seconds of speech: fragments of 1-12 words separated by pauses,
+    about 10% of fragments have a word with low confidence
+    """
+    rng = np.random.default_rng(seed)
+    json_data = []
+    time_ = rng.uniform(0.2, 1.0)
+    while True:
+        words = []
+        low_conf = rng.random() < 0.1
+        for _ in range(rng.integers(1, 13)):
+            length = rng.uniform(0.15, 0.5)
+            if time_ + length > duration - 0.5:
+                break
+            words.append({'conf': 1.0, 'end': round(time_ + length, 2), 'start': round(time_, 2),
+                          'word': _vocabulary[rng.integers(len(_vocabulary))]})
+            time_ += length + rng.uniform(0.03, 0.12)
+        if not words:
+            return json_data
+        if low_conf:
+            words[rng.integers(len(words))]['conf'] = round(rng.uniform(0.4, 0.95), 6)
+        json_data.append({'result': words, 'text': ' '.join([word['word'] for word in words])})
+        time_ += rng.uniform(0.3, 1.2)
+
+
+def synthetic_speech(json_data, duration, sample_rate, seed=0):
+    """
+    Audio for text fragments: a voiced burst (harmonics of a random pitch) with a varying envelope for every word
+    and quiet noise between words
+
+    :return: np.int16 array
+    """
+    rng = np.random.default_rng(seed)
+    audio = rng.standard_normal(int(duration * sample_rate)) * 20
+    harmonics = np.arange(1, 11)[:, None]
+    for item in json_data:
+        for word in item['result']:
+            begin, end = int(word['start'] * sample_rate), int(word['end'] * sample_rate)
+            envelope = np.sin(np.linspace(0, np.pi, end - begin)) * rng.uniform(0.3, 1.0)
+            phase = 2 * np.pi * rng.uniform(90, 250) * np.arange(end - begin) / sample_rate
+            voice = np.sum(np.sin(harmonics * phase) / harmonics, axis=0)
+            audio[begin:end] += (voice + rng.standard_normal(end - begin) * 0.1) * envelope * 4000
+    return np.clip(audio, -32768, 32767).astype(np.int16)
+
+
+def punctuate_script(json_data):
+    """
+    Capital letter in the beginning and period in the end of every fragment
+    """
+    result = []
+    for item in json_data:
+        words = [dict(word) for word in item.get('result', [])]
+        if words:
+            words[0]['word'] = words[0]['word'].capitalize()
+            words[-1]['word'] += '.'
+            result.append({'result': words, 'text': ' '.join([word['word'] for word in words])})
+        else:
+            result.append(dict(item))
+    return result
+
+
+def synthetic_corpus(n_files, file_duration=60.0, raw=False, seed=0):
+    """
+    Write synthetic corpus to `data` folder of the current directory
+
+    Text fragments of every file are written to SCRIPT_DATA_PATH
+
+    :param n_files: number of audio files
+    :param file_duration: duration of every file (sec)
+    :param raw: write 44.1 kHz files to RAW_DATA_PATH for the whole pipeline,
+    otherwise write SAMPLE_RATE files to INPUT_DATA_PATH and text fragments to ASR_DATA_PATH and PUNC_DATA_PATH
+    """
+    sample_rate = 44100 if raw else settings.SAMPLE_RATE
+    wav_path = settings.RAW_DATA_PATH if raw else settings.INPUT_DATA_PATH
+    if not os.path.exists(wav_path):
+        os.makedirs(wav_path)
+
+    for i in range(n_files):
+        name = 'file%03d' % i
+        json_data = synthetic_script(file_duration, seed=seed + i)
+        write_wav(os.path.join(wav_path, name + '.wav'),
+                  synthetic_speech(json_data, file_duration, sample_rate, seed=seed + i), sample_rate)
+        save_transcript(os.path.join(SCRIPT_DATA_PATH, name + '.json'), json_data)
+        if not raw:
+            save_transcript(os.path.join(settings.ASR_DATA_PATH, name + '.json'), json_data)
+            save_transcript(os.path.join(settings.PUNC_DATA_PATH, name + '.json'), punctuate_script(json_data))
+
+
+class StubSpeechToText:
+    """
+    Stand-in for models.SpeechToText: returns text fragments the synthetic .wav file was made from
+    """
+
+    def __init__(self, dir_model=None, lang='en'):
+        pass
+
+    def predict(self, dir_wav, progress=True):
+        local_path = os.path.relpath(dir_wav, settings.INPUT_DATA_PATH)
+        return load_transcript(os.path.join(SCRIPT_DATA_PATH, os.path.splitext(local_path)[0] + '.json'))
+
+    def predict_chunked(self, dir_wav, chunk_duration, overlap=2.0, search_duration=10.0, workers=1):
+        return self.predict(dir_wav)
+
+    def predict_regions(self, dir_wav, regions, workers=1, chunk_duration=0, overlap=2.0, search_duration=10.0):
+        rate = read_wav(dir_wav)[1]
+        result = []
+        for item in self.predict(dir_wav):
+            words = [word for word in item.get('result', [])
+                     if any(begin <= (word['start'] + word['end']) / 2 * rate < end for begin, end in regions)]
+            if words:
+                result.append({'result': words, 'text': ' '.join([word['word'] for word in words])})
+        return result
+
+
+class StubPunctuationPredictor:
+    """
+    Stand-in for models.PunctuationPredictor: capital letter and period for every fragment
+    """
+
+    def __init__(self, dir_model=None, lang='en', model=None, threads=None):
+        pass
+
+    def predict(self, json_data):
+        return punctuate_script(json_data)
+
+    def predict_batch(self, json_list, batch_size=16, names=None):
+        return [self.predict(json_data) for json_data in json_list]
+
+
+@contextlib.contextmanager
+def temporary_workdir():
+    """
+    Run in a new temporary directory, so relative data paths of settings.py point to the synthetic corpus
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(cwd)
+
+
+def timed(results, name, func, *args):
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args)
+    results[name] = time.perf_counter() - start_time
+    return result
+
+
+def print_scaling(title, sizes, audio_minutes, results):
+    """
+    Time of every stage for every corpus size and scaling exponent k of time ~ size^k
+    between the smallest and the largest corpus (1.0 is linear)
+    """
+    print(title)
+    print('%-16s' % 'files' + ''.join(['%10d' % size for size in sizes]) + '%10s' % 'k')
+    print('%-16s' % 'audio, min' + ''.join(['%10.1f' % minutes for minutes in audio_minutes]))
+    for stage in results[0]:
+        times = [result[stage] for result in results]
+        k = math.log(times[-1] / times[0]) / math.log(sizes[-1] / sizes[0]) \
+            if len(sizes) > 1 and times[0] > 0 and times[-1] > 0 else float('nan')
+        print('%-16s' % stage + ''.join(['%10.3f' % t for t in times]) + '%10.2f' % k)
+
+
+def benchmark_stages(sizes=(2, 8, 32), file_duration=60.0):
+    """
+    Time stages after punctuation restoring on synthetic corpora of several sizes
+
+    :return: list of {stage: time (sec)} for every size
+    """
+    import labeling
+
+    results = []
+    for n_files in sizes:
+        with temporary_workdir():
+            synthetic_corpus(n_files, file_duration)
+            result = {}
+
+            # silence trimming alone: every fragment of every file
+            fragments = []
+            for i in range(n_files):
+                samples, frame_rate = read_wav(os.path.join(settings.INPUT_DATA_PATH, 'file%03d.wav' % i))
+                for item in load_transcript(os.path.join(SCRIPT_DATA_PATH, 'file%03d.json' % i)):
+                    start, end = item['result'][0]['start'], item['result'][-1]['end']
+                    fragments.append(slice_samples(samples, frame_rate, start * 1000, end * 1000))
+            timed(result, 'trimming', lambda: [detect_silence(sample, frame_rate) for sample in fragments])
+
+            gain, dataframe_list = timed(result, 'cutting', labeling.process_samples)
+            gains = timed(result, 'normalization', normalization_gains, gain)
+            timed(result, 'export', labeling.export_samples, dataframe_list, gains)
+
+            metadata = pd.concat(dataframe_list, axis=0)[['name', 'text']]
+            metadata['text'] = timed(result, 'cleaning', english_cleaner_series, metadata['text'])
+            timed(result, 'metadata', lambda: metadata.to_csv(settings.METADATA_PATH, sep='|', header=False,
+                                                              index=False))
+            timed(result, 'statistics', dataset_stat, settings.WAVS_DATA_PATH, settings.METADATA_PATH,
+                  settings.DATASET_STAT_PATH)
+            results.append(result)
+
+    print_scaling('stages', sizes, [n_files * file_duration / 60 for n_files in sizes], results)
+    return results
+
+
+def benchmark_pipeline(sizes=(2, 8), file_duration=60.0):
+    """
+    Time the whole labeling.py pipeline with StubSpeechToText and StubPunctuationPredictor
+
+    :return: list of {stage: time (sec)} for every size
+    """
+    import models
+    import labeling
+
+    model_classes = models.SpeechToText, models.PunctuationPredictor
+    models.SpeechToText, models.PunctuationPredictor = StubSpeechToText, StubPunctuationPredictor
+    results = []
+    try:
+        for n_files in sizes:
+            with temporary_workdir():
+                synthetic_corpus(n_files, file_duration, raw=True)
+                labeling.profiler = Profiler()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    labeling.main()
+                result = {stage['stage']: stage['wall_time'] for stage in labeling.profiler.stages}
+                result['total'] = sum(result.values())
+                results.append(result)
+    finally:
+        models.SpeechToText, models.PunctuationPredictor = model_classes
+
+    print_scaling('pipeline', sizes, [n_files * file_duration / 60 for n_files in sizes], results)
+    return results
+
+
+def benchmark_punctuation_workers(workers=(1, 4, 16), n_files=32, file_duration=60.0):
+    """
+    Time the punctuation stage with TorchCasePuncPredictor for several PUNC_WORKERS
+
+    :return: {workers: time (sec)}
+    """
+    import shutil
+    import torch  # noqa: F401 not timed, workers are forked with torch imported
+    import models
+    import labeling
+
+    model_class, default_workers = models.PunctuationPredictor, settings.PUNC_WORKERS
+    models.PunctuationPredictor = torch_punctuation_predictor(model_class)
+    results = {}
+    try:
+        with temporary_workdir():
+            synthetic_corpus(n_files, file_duration)
+            n_words = sum([len(item['result']) for i in range(n_files)
+                           for item in load_transcript(os.path.join(SCRIPT_DATA_PATH, 'file%03d.json' % i))])
+            for n_workers in workers:
+                shutil.rmtree(settings.PUNC_DATA_PATH, ignore_errors=True)
+                shutil.rmtree(settings.CACHE_DATA_PATH, ignore_errors=True)
+                settings.PUNC_WORKERS = n_workers
+                labeling.profiler = Profiler()
+                timed(results, n_workers, labeling.restore_punctuation)
+    finally:
+        models.PunctuationPredictor, settings.PUNC_WORKERS = model_class, default_workers
+
+    print('punctuation workers, %d files, %d words, %d CPU cores' % (n_files, n_words, os.cpu_count()))
+    print('%-10s%10s%12s%10s' % ('workers', 'time, s', 'words/sec', 'speedup'))
+    for n_workers, elapsed in results.items():
+        print('%-10d%10.2f%12.0f%10.2f' % (n_workers, elapsed, n_words / elapsed, results[workers[0]] / elapsed))
+    return results
+
+
+def run_shard(shard):
+    """
+    Run stages of shard (i, n) of labeling.py with StubSpeechToText and StubPunctuationPredictor
+    on the synthetic corpus in the current directory
+    """
+    import models
+    import labeling
+
+    models.SpeechToText, models.PunctuationPredictor = StubSpeechToText, StubPunctuationPredictor
+    with contextlib.redirect_stdout(io.StringIO()):
+        labeling.main(labeling.SHARD_STAGES[0], labeling.SHARD_STAGES[-1], shard=shard)
+
+
+def benchmark_shards(n_shards=4, n_files=8, file_duration=60.0):
+    """
+    Run labeling.py on a synthetic corpus as one process and as n_shards processes sharing one data folder
+    (`python benchmark.py shard --shard i/N`) merged by one more run, check that the datasets are identical
+
+    :return: {'single': time (sec), 'shards': time (sec), 'merge': time (sec), 'identical': bool}
+    """
+    import sys
+    import filecmp
+    import subprocess
+    import models
+    import labeling
+
+    outputs = [settings.METADATA_PATH, settings.DATASET_STAT_PATH, settings.NORMALIZED_SAMPLES_PATH,
+               settings.TRAIN_PATH, settings.VAL_PATH, settings.TEST_PATH]
+    model_classes = models.SpeechToText, models.PunctuationPredictor
+    models.SpeechToText, models.PunctuationPredictor = StubSpeechToText, StubPunctuationPredictor
+    result = {}
+    try:
+        with temporary_workdir() as path:
+            single, sharded = os.path.join(path, 'single'), os.path.join(path, 'sharded')
+            for workdir in [single, sharded]:
+                os.makedirs(workdir)
+                os.chdir(workdir)
+                synthetic_corpus(n_files, file_duration, raw=True)
+
+            os.chdir(single)
+            labeling.profiler = Profiler()
+            timed(result, 'single', labeling.main)
+
+            os.chdir(sharded)
+            start_time = time.perf_counter()
+            processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'shard', '--shard',
+                                           '%d/%d' % (i, n_shards)], stderr=subprocess.DEVNULL)
+                         for i in range(n_shards)]
+            if any([process.wait() for process in processes]):
+                raise RuntimeError('a shard failed')
+            result['shards'] = time.perf_counter() - start_time
+            labeling.profiler = Profiler()
+            timed(result, 'merge', labeling.main, 'normalization', 'dataset_stat', None, n_shards)
+
+            names = sorted(os.listdir(os.path.join(single, settings.WAVS_DATA_PATH)))
+            result['identical'] = names == sorted(os.listdir(os.path.join(sharded, settings.WAVS_DATA_PATH))) \
+                and all([filecmp.cmp(os.path.join(single, settings.WAVS_DATA_PATH, name),
+                                     os.path.join(sharded, settings.WAVS_DATA_PATH, name), shallow=False)
+                         for name in names]) \
+                and all([filecmp.cmp(os.path.join(single, output), os.path.join(sharded, output), shallow=False)
+                         for output in outputs])
+    finally:
+        models.SpeechToText, models.PunctuationPredictor = model_classes
+
+    print('shards: %d files, one process %.2f sec, %d shards %.2f sec + merge %.2f sec, datasets are %s'
+          % (n_files, result['single'], n_shards, result['shards'], result['merge'],
+             'identical' if result['identical'] else 'DIFFERENT'))
+    return result
+
+
+# modules imported by every stage besides labeling.py
+STAGE_IMPORTS = {
+    'preprocess': [],
+    'quality': [],
+    'asr': ['vosk'],
+    'punctuation': ['torch', 'transformers'],
+    'process_samples': ['pandas'],
+    'normalization': ['pandas'],
+    'export': ['pandas'],
+    'metadata': ['pandas'],
+    'dataset_stat': ['pandas'],
+}
+
+
+def benchmark_startup():
+    """
+    Startup time and peak RSS of a new process importing labeling.py and the modules of every stage
+
+    :return: {stage: (import time (sec), process time (sec), peak RSS (MB))}
+    """
+    import sys
+    import json
+    import subprocess
+
+    code = '\n'.join([
+        'import sys, json, time, resource',
+        't = time.perf_counter()',
+        'import labeling',
+        'missing = []',
+        'for name in sys.argv[1:]:',
+        '    try:',
+        '        __import__(name)',
+        '    except ImportError:',
+        '        missing.append(name)',
+        'print(json.dumps([time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, missing]))',
+    ])
+    results = {}
+    print('startup')
+    print('%-16s%12s%12s%10s' % ('stage', 'import, s', 'process, s', 'RSS, MB'))
+    for stage, modules in STAGE_IMPORTS.items():
+        start_time = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code] + modules, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        elapsed = time.perf_counter() - start_time
+        import_time, rss, missing = json.loads(output.decode().strip().split('\n')[-1])
+        results[stage] = (import_time, elapsed, rss / 1024)
+        print('%-16s%12.2f%12.2f%10.0f' % (stage, import_time, elapsed, rss / 1024)
+              + ('  (not installed: %s)' % ', '.join(missing) if missing else ''))
+    return results
+
+
+def save_results(path, name, sizes, results):
+    rows = [dict(result, benchmark=name, files=size) for size, result in zip(sizes, results)]
+    pd.DataFrame(rows).to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the labeling hot paths on synthetic data')
+    parser.add_argument('benchmark', nargs='?', default='all',
+                        choices=['all', 'micro', 'startup', 'stages', 'pipeline', 'shards', 'shard', 'punctuation'])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 8, 32], help='number of files in a corpus')
+    parser.add_argument('--file-duration', type=float, default=60.0, help='duration of every file (sec)')
+    parser.add_argument('--output', help='append times to .csv file')
+    parser.add_argument('--shards', type=int, default=4, help='number of shards of the shards benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+                        help='numbers of workers of the punctuation benchmark')
+    parser.add_argument('--shard', help='i/N: run shard i of N on the synthetic corpus in the current directory '
+                                        '(started by the shards benchmark)')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    if args.benchmark == 'shard':
+        run_shard(tuple([int(part) for part in args.shard.split('/')]))
+
+    if args.benchmark in ['all', 'micro']:
+        benchmark_silence_trimming()
+        benchmark_punctuation_restore()
+        benchmark_split()
+    if args.benchmark in ['all', 'startup']:
+        benchmark_startup()
+    if args.benchmark in ['all', 'stages']:
+        results = benchmark_stages(args.sizes, args.file_duration)
+        if output:
+            save_results(output, 'stages', args.sizes, results)
+    if args.benchmark in ['all', 'pipeline']:
+        results = benchmark_pipeline(args.sizes, args.file_duration)
+        if output:
+            save_results(output, 'pipeline', args.sizes, results)
+    if args.benchmark in ['all', 'shards']:
+        benchmark_shards(args.shards, max(args.sizes), args.file_duration)
+    if args.benchmark in ['all', 'punctuation']:
+        benchmark_punctuation_workers(args.workers, max(args.sizes), args.file_duration)
@@ -1,108 +1,409 @@
 import os
-import sys
-import json
-import glob
+import time
 import tqdm
+import argparse
 
-import pydub
-import pandas as pd
-from transformers import logging
+import numpy as np
 
 import settings
-from models import SpeechToText, PunctuationPredictor
-from utils.audio_utils import detect_leading_silence, normalize_audio
-from utils.text_cleaners import english_cleaner
-from utils.utils import dataset_stat
+import models
+from utils.audio_utils import detect_silence, normalization_gains, convert_audio, loudness_stats, RunningStats
+from utils.audio_utils import read_wav, write_wav, slice_samples, duration_ms, silence_frames, samples_dbfs, apply_gain
+from utils.text_cleaners import english_cleaner_series
+from utils.utils import dataset_stat, parallel_map, wav_duration, scan_dataset, DatasetStats
+from utils.cache import StageCache, file_hash
+from utils.corpus import CorpusIndex
+from utils.transcripts import save_transcript, load_transcript, load_columns
+from utils.segmentation import fragment_ranges, segment_words, segments_yield, speech_duration
+from utils.profiling import Profiler
+from utils.split import split_by_duration
+from utils.quality import frame_metrics, bad_frames, skip_regions, keep_regions, clip_quality, save_metrics, \
+    load_metrics
+
+# pandas and the models (vosk, torch, transformers, recasepunc) are imported by the stages which use them
+
+
+stt = None
+punc_predictor = None
+profiler = Profiler(settings.PROFILE_DATA_PATH if settings.PROFILE_STAGES else None)
+current_shard = None  # (i, n) if this process runs shard i of n shards, see main
+merged_shards = None  # number of shards merged by the normalization stage, see main
+verify_stat = False  # recompute dataset statistics from disk, see main
+
+
+def shard_path(path, shard):
+    """
+    Path of a file written by every shard separately, e.g. data/cache/asr.json -> data/cache/asr.1-of-4.json
+
+    :param shard: (i, n) or None for the path of a run without shards
+    """
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s.%d-of-%d%s' % (root, shard[0], shard[1], ext)
+
+
+def corpus_index(build=False):
+    """
+    Load corpus index, build it by walking RAW_DATA_PATH if required or if it does not exist
+
+    A shard has its own index with only the sources of the shard
+    """
+    path = shard_path(settings.CORPUS_INDEX_PATH, current_shard)
+    index = CorpusIndex(path)
+    if build or not os.path.exists(path):
+        index.build(settings.RAW_DATA_PATH, settings.RAW_FORMATS, settings.INPUT_DATA_PATH, settings.ASR_DATA_PATH,
+                    settings.PUNC_DATA_PATH, settings.TRANSCRIPT_FORMAT, settings.QUALITY_DATA_PATH)
+        if current_shard is not None:
+            index.shard(*current_shard)
+        index.save()
+    return index
+
+
+def quality_metrics(wav_path, metrics_path=None):
+    """
+    Framewise quality metrics of an input audio file, read from metrics_path if the quality stage wrote it,
+    otherwise measured and written to metrics_path, so later stages and runs do not measure the file again
+
+    :return: metrics (see utils.quality), number of audio frames, frame rate (Hz)
+    """
+    samples, frame_rate = read_wav(wav_path)
+    frame_length = max(int(round(settings.QUALITY_FRAME_DURATION * frame_rate)), 1)
+    if metrics_path is not None and os.path.exists(metrics_path):
+        metrics = load_metrics(metrics_path)
+        if metrics['frame_length'] == frame_length and len(metrics['energy']) == len(samples) // frame_length:
+            return metrics, len(samples), frame_rate
+    metrics = frame_metrics(samples, frame_rate, settings.QUALITY_FRAME_DURATION, settings.QUALITY_BLOCK_DURATION)
+    if metrics_path is not None:
+        save_metrics(metrics_path, metrics)
+    return metrics, len(samples), frame_rate
+
+
+def gated_regions(metrics, n_frames, frame_rate):
+    """
+    Regions of an input audio file passed to speech recognition with QUALITY_GATING thresholds
+
+    :return: list of (begin, end) kept audio frames, skipped audio (sec)
+    """
+    bad = bad_frames(metrics, settings.QUALITY_MIN_SNR, settings.QUALITY_MAX_CLIPPING,
+                     settings.QUALITY_MAX_FLATNESS, settings.QUALITY_SILENCE_THRESHOLD)
+    skipped = skip_regions(bad, metrics['frame_length'],
+                           int(round(settings.QUALITY_MIN_SKIP / settings.QUALITY_FRAME_DURATION)),
+                           int(round(settings.QUALITY_PAD / settings.QUALITY_FRAME_DURATION)))
+    return keep_regions(skipped, n_frames), sum([end - begin for begin, end in skipped]) / frame_rate
 
-sys.path.insert(0, settings.PUNC_MODEL)
-from recasepunc import CasePuncPredictor
-from recasepunc import WordpieceTokenizer
 
-logging.set_verbosity_error()
+def quality_worker(paths):
+    """
+    Measure framewise quality of one input audio file
 
+    :param paths: (input .wav path, output .npz path)
+    :return: input .wav path, audio duration (sec), audio to skip (sec), processing time (sec), CPU time (sec)
+    """
+    i_path, o_path = paths
+    start_time, start_cpu = time.time(), time.process_time()
+    samples, frame_rate = read_wav(i_path)
+    metrics = frame_metrics(samples, frame_rate, settings.QUALITY_FRAME_DURATION, settings.QUALITY_BLOCK_DURATION)
+    save_metrics(o_path, metrics)
+    _, skipped = gated_regions(metrics, len(samples), frame_rate)
+    return i_path, len(samples) / frame_rate, skipped, time.time() - start_time, time.process_time() - start_cpu
 
-def obj_dict(obj):
-    return obj.__dict__
+
+def analyze_quality():
+    """
+    Measure energy, estimated SNR, clipping and spectral flatness of every frame of input audio files
+    by PREPROCESS_WORKERS processes and report audio which speech recognition will skip (see QUALITY_GATING)
+
+    Only new or changed files are processed
+
+    Read .wav from INPUT_DATA_PATH
+
+    Write .npz to QUALITY_DATA_PATH
+    """
+    cache = StageCache(shard_path(os.path.join(settings.CACHE_DATA_PATH, 'quality.json'), current_shard), {
+        'QUALITY_FRAME_DURATION': settings.QUALITY_FRAME_DURATION,
+        'QUALITY_BLOCK_DURATION': settings.QUALITY_BLOCK_DURATION,
+    })
+
+    index = corpus_index()
+    sources = {index[source]['input']: source for source in index if os.path.exists(index[source]['input'])}
+    input_paths = list(sources)
+    output_paths = {path: index[source]['quality'] for path, source in sources.items()}
+
+    cache.prune(input_paths)
+    tasks = [(path, output_paths[path]) for path in input_paths if not cache.is_done(path, [output_paths[path]])]
+
+    total_duration, total_skipped = 0, 0
+    try:
+        for path, duration, skipped, elapsed, cpu in parallel_map(quality_worker, tasks,
+                                                                   settings.PREPROCESS_WORKERS):
+            cache.done(path, [output_paths[path]])
+            index.update(sources[path], status='quality')
+            profiler.add_file('quality', path, elapsed, cpu, duration)
+            total_duration += duration
+            total_skipped += skipped
+    finally:
+        cache.save()
+        index.save()
+
+    if total_duration > 0:
+        print('quality: %.1f of %.1f sec of audio (%.1f%%) %s'
+              % (total_skipped, total_duration, 100 * total_skipped / total_duration,
+                 'will be skipped by speech recognition' if settings.QUALITY_GATING
+                 else 'is of bad quality (QUALITY_GATING is off)'))
+
+
+def init_asr_worker():
+    """
+    Load speech recognition model once per worker process
+    """
+    global stt
+    stt = models.SpeechToText(dir_model=settings.ASR_MODEL, lang=settings.LANG)
+
+
+def asr_worker(paths):
+    """
+    Predict text fragments for one audio file and write them as soon as they are ready
+
+    With QUALITY_GATING only regions of good quality are recognized
+
+    :param paths: (input .wav path, output .json or .npz path, quality metrics .npz path)
+    :return: input .wav path, audio duration (sec), skipped audio (sec), processing time (sec), CPU time (sec)
+    """
+    i_path, o_path, q_path = paths
+    print('processing:', i_path)
+    start_time, start_cpu = time.time(), time.process_time()
+    skipped = 0.0
+    if settings.QUALITY_GATING:
+        regions, skipped = gated_regions(*quality_metrics(i_path, q_path))
+    if skipped > 0:
+        # long kept regions are split into chunks as without gating
+        workers = settings.ASR_CHUNK_WORKERS if settings.ASR_CHUNK_DURATION > 0 else 1
+        predictions = stt.predict_regions(i_path, regions, workers=workers, chunk_duration=settings.ASR_CHUNK_DURATION,
+                                          overlap=settings.ASR_CHUNK_OVERLAP,
+                                          search_duration=settings.ASR_CHUNK_SEARCH)
+    elif settings.ASR_CHUNK_DURATION > 0:
+        predictions = stt.predict_chunked(i_path, settings.ASR_CHUNK_DURATION, overlap=settings.ASR_CHUNK_OVERLAP,
+                                          search_duration=settings.ASR_CHUNK_SEARCH,
+                                          workers=settings.ASR_CHUNK_WORKERS)
+    else:
+        predictions = stt.predict(i_path, progress=settings.ASR_WORKERS <= 1)
+    save_transcript(o_path, predictions)
+    samples, frame_rate = read_wav(i_path)
+    return i_path, len(samples) / frame_rate, skipped, time.time() - start_time, time.process_time() - start_cpu
 
 
 def automatic_speech_recognition():
     """
     Read audio files and predict text fragments and start, end, confidence for each word
 
-    Read .wav from INPUT_DATA_PATH
+    Files are distributed between ASR_WORKERS processes, each worker loads the model once
+
+    With QUALITY_GATING regions of bad quality are skipped (see analyze_quality), the ASR time saved
+    is estimated by the real-time factor of recognized audio
+
+    Only new or changed files are processed
+
+    Read .wav from INPUT_DATA_PATH and .npz from QUALITY_DATA_PATH
 
-    Write .json to ASR_DATA_PATH
+    Write .json or .npz (TRANSCRIPT_FORMAT) to ASR_DATA_PATH
     """
-    input_paths = glob.glob(os.path.join(settings.INPUT_DATA_PATH, '**', '*.wav'), recursive=True)
-    output_paths = []
-    for path in input_paths:
-        local_path = os.path.relpath(path, settings.INPUT_DATA_PATH)
-        local_path = local_path.replace('.wav', '.json')
-        output_paths.append(os.path.join(settings.ASR_DATA_PATH, local_path))
+    asr_settings = {
+        'ASR_MODEL': settings.ASR_MODEL,
+        'LANG': settings.LANG,
+        'SAMPLE_RATE': settings.SAMPLE_RATE,
+        'ASR_CHUNK_DURATION': settings.ASR_CHUNK_DURATION,
+        'ASR_CHUNK_OVERLAP': settings.ASR_CHUNK_OVERLAP,
+        'ASR_CHUNK_SEARCH': settings.ASR_CHUNK_SEARCH,
+    }
+    if settings.QUALITY_GATING:
+        asr_settings.update({name: getattr(settings, name) for name in [
+            'QUALITY_FRAME_DURATION', 'QUALITY_BLOCK_DURATION', 'QUALITY_MIN_SNR', 'QUALITY_MAX_CLIPPING',
+            'QUALITY_MAX_FLATNESS', 'QUALITY_SILENCE_THRESHOLD', 'QUALITY_MIN_SKIP', 'QUALITY_PAD']})
+    cache = StageCache(shard_path(os.path.join(settings.CACHE_DATA_PATH, 'asr.json'), current_shard), asr_settings)
+
+    index = corpus_index()
+    sources = {index[source]['input']: source for source in index if os.path.exists(index[source]['input'])}
+    input_paths = list(sources)
+    output_paths = {path: index[source]['asr'] for path, source in sources.items()}
+
+    cache.prune(input_paths)
+    tasks = [(path, output_paths[path], index[sources[path]].get('quality')) for path in input_paths
+             if not cache.is_done(path, [output_paths[path]])]
+
+    # recognized and skipped audio (sec), processing time (sec)
+    recognized, total_skipped, total_elapsed = 0.0, 0.0, 0.0
+    try:
+        for path, duration, skipped, elapsed, cpu in parallel_map(asr_worker, tasks, settings.ASR_WORKERS,
+                                                                   initializer=init_asr_worker):
+            cache.done(path, [output_paths[path]])
+            index.update(sources[path], duration=duration, skipped=skipped, status='asr')
+            profiler.add_file('asr', path, elapsed, cpu, duration)
+            recognized += duration - skipped
+            total_skipped += skipped
+            total_elapsed += elapsed
+    finally:
+        cache.save()
+        index.save()
+
+    if total_skipped > 0 and recognized > 0:
+        saved = total_skipped * total_elapsed / recognized
+        print('quality gating: %.1f of %.1f sec of audio skipped, ~%.1f sec of ASR time saved (%.1f%%)'
+              % (total_skipped, recognized + total_skipped, saved, 100 * saved / (total_elapsed + saved)))
+
+
+def init_punc_worker():
+    """
+    Load punctuation model once per worker process, torch threads of all workers share the CPU cores
+    """
+    global punc_predictor
+    threads = settings.PUNC_THREADS or max(1, (os.cpu_count() or 1) // max(settings.PUNC_WORKERS, 1))
+    punc_predictor = models.PunctuationPredictor(settings.PUNC_MODEL, lang=settings.LANG, threads=threads)
 
-    stt = SpeechToText(dir_model=settings.ASR_MODEL, lang=settings.LANG)
 
-    for i_path, o_path in zip(input_paths, output_paths):
-        print('processing:', i_path)
-        predictions = stt.predict(i_path)
+def punc_worker(group):
+    """
+    Predict punctuation and capital letters for a group of files at once and write every file
 
-        dir_name = os.path.dirname(o_path)
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
+    :param group: list of (input .json or .npz path, output .json or .npz path)
+    :return: list of (input path, number of words, audio duration (sec)), processing time (sec), CPU time (sec)
+    """
+    start_time, start_cpu = time.time(), time.process_time()
+    json_list = [load_transcript(i_path) for i_path, _ in group]
+    json_list = punc_predictor.predict_batch(json_list, batch_size=settings.PUNC_BATCH_SIZE,
+                                             names=[i_path for i_path, _ in group])
 
-        with open(o_path, 'w') as f:
-            json.dump(predictions, f, default=obj_dict, indent=4, ensure_ascii=False)
+    files = []
+    for (i_path, o_path), data in zip(group, json_list):
+        save_transcript(o_path, data)
+        ends = [item['result'][-1]['end'] for item in data if item.get('result')]
+        files.append((i_path, sum([len(item.get('result', [])) for item in data]), max(ends) if ends else None))
+    return files, time.time() - start_time, time.process_time() - start_cpu
 
 
 def restore_punctuation():
     """
     Predict punctuation and capital letters for each text fragment
 
-    Read .json from ASR_DATA_PATH
+    Files are processed in groups of up to PUNC_BATCH_FILES distributed between PUNC_WORKERS processes,
+    each worker loads the model once and uses its share of CPU cores for torch threads (PUNC_THREADS).
+    Groups of the largest files are scheduled first, so the last groups are short and workers finish together
 
-    Write .json to PUNC_DATA_PATH
-    """
-    punc_predictor = PunctuationPredictor(settings.PUNC_MODEL, lang=settings.LANG)
-
-    input_paths = sorted(glob.glob(os.path.join(settings.ASR_DATA_PATH, '**', '*.json'), recursive=True))
-    output_paths = []
-    for path in input_paths:
-        local_path = os.path.relpath(path, settings.ASR_DATA_PATH)
-        output_paths.append(os.path.join(settings.PUNC_DATA_PATH, local_path))
+    Only new or changed files are processed
 
-    for i_path, o_path in zip(input_paths, output_paths):
-        with open(i_path, encoding='utf8') as f:
-            data = json.load(f)
+    Read .json or .npz (TRANSCRIPT_FORMAT) from ASR_DATA_PATH
 
-        data = punc_predictor.predict(data)
+    Write .json or .npz (TRANSCRIPT_FORMAT) to PUNC_DATA_PATH
+    """
+    global punc_predictor
+    cache = StageCache(shard_path(os.path.join(settings.CACHE_DATA_PATH, 'punc.json'), current_shard), {
+        'PUNC_MODEL': settings.PUNC_MODEL,
+        'LANG': settings.LANG,
+    })
+
+    index = corpus_index()
+    sources = {index[source]['asr']: source for source in index if os.path.exists(index[source]['asr'])}
+    input_paths = list(sources)
+    output_paths = [index[source]['punc'] for source in sources.values()]
+
+    cache.prune(input_paths)
+    tasks = [(i_path, o_path) for i_path, o_path in zip(input_paths, output_paths)
+             if not cache.is_done(i_path, [o_path])]
+    if not tasks:
+        # nothing to predict, keep the pruned entries of removed files
+        cache.save()
+        return
+
+    # files are processed in groups, token windows of a group are predicted in batches of PUNC_BATCH_SIZE,
+    # file size is the estimate of the number of words
+    outputs = dict(tasks)
+    tasks = sorted(tasks, key=lambda task: os.path.getsize(task[0]), reverse=True)
+    batch_files = settings.PUNC_BATCH_FILES
+    if settings.PUNC_WORKERS > 1:
+        # at least 4 groups for every worker
+        batch_files = min(batch_files, max(1, -(-len(tasks) // (4 * settings.PUNC_WORKERS))))
+    groups = [tasks[i:i + batch_files] for i in range(0, len(tasks), batch_files)]
+
+    n_files, n_words = 0, 0
+    start_time = time.time()
+    try:
+        for files, group_time, group_cpu in parallel_map(punc_worker, groups, settings.PUNC_WORKERS,
+                                                         initializer=init_punc_worker):
+            group_words = sum([words for _, words, _ in files])
+            for i_path, words, duration in files:
+                cache.done(i_path, [outputs[i_path]])
+                index.update(sources[i_path], status='punctuation')
+                # files of a group are predicted together, time is shared between files by number of words
+                share = words / max(group_words, 1)
+                profiler.add_file('punctuation', i_path, group_time * share, group_cpu * share, duration)
+            n_files += len(files)
+            n_words += group_words
+            print('punctuation: %d/%d files, %.1f words/sec'
+                  % (n_files, len(tasks), n_words / (time.time() - start_time)))
+    finally:
+        punc_predictor = None  # model loaded in this process with PUNC_WORKERS = 1
+        cache.save()
+        index.save()
+
+
+def cut_sample(samples, frame_rate, start, end, begin_trim=0, end_trim=0):
+    """
+    Cut sample from memory-mapped audio file and trim silence in the beginning and the end of a sample
 
-        dir_name = os.path.dirname(o_path)
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
+    Positions are computed in the same way as pydub.AudioSegment slicing, the sample is a view of the file
 
-        with open(o_path, 'w') as f:
-            json.dump(data, f, default=obj_dict, indent=4, ensure_ascii=False)
+    :param samples: samples of the whole audio file (from read_wav)
+    :param frame_rate: frame rate (Hz)
+    :param start: start of the first word (sec)
+    :param end: end of the last word (sec)
+    :param begin_trim: silence in the beginning of a sample (ms)
+    :param end_trim: silence in the end of a sample (ms)
+    """
+    sample = slice_samples(samples, frame_rate, start * 1000, end * 1000)
+    return slice_samples(sample, frame_rate, begin_trim, duration_ms(sample, frame_rate) - end_trim)
 
 
 def process_samples():
     """
-    Cut input audio files into samples by predicted start/end values
+    Cut input audio files into samples by predicted start/end values and measure samples volume
 
     Threshold samples by mean confidence of fragment and duration
 
-    Read .json from PUNC_DATA_PATH
+    With SEGMENTATION short fragments are merged and long ones are split at pauses between words
+    to fit more transcribed audio into MIN_TIME - MAX_TIME (see utils.segmentation.segment_words)
+
+    Samples are not kept in memory, only the cut positions are returned to export samples with export_samples
+
+    Every sample gets its duration with the added silence (duration, sec) and quality columns for filtering:
+    mean estimated SNR (snr, dB), fraction of clipped samples (clipping) and mean spectral flatness (flatness)
+    of its audio (see utils.quality)
+
+    Audio files and text fragments are paired by the corpus index
 
-    :return: audio segments, samples volume, dataset file names and text label
+    Read .json or .npz (TRANSCRIPT_FORMAT) from PUNC_DATA_PATH
+
+    :return: samples volume, dataset file names, text labels and cut positions
     """
-    asr_paths = sorted(glob.glob(os.path.join(settings.PUNC_DATA_PATH, '**', '*.json'), recursive=True))
-    input_paths = sorted(glob.glob(os.path.join(settings.INPUT_DATA_PATH, '**', '*.wav'), recursive=True))
+    import pandas as pd
+
+    index = corpus_index()
+
+    # duration window of word times, silence is added to samples
+    padding = (settings.SILENCE_START + settings.SILENCE_END) / 1000
+    min_span, max_span = settings.MIN_TIME - padding, settings.MAX_TIME - padding
+    # speech kept estimated by word times without and with segmentation, transcribed speech, speech of samples (sec)
+    estimates = [0.0, 0.0, 0.0]
+    kept_speech = 0.0
 
     dataframe_list = []
-    samples = []
     gain = []
     source_id = 1
-    sum_time = 0
-    for asr_path, pdc_path in zip(asr_paths, input_paths):
+    for source in index:
+        asr_path, pdc_path = index[source]['punc'], index[source]['input']
+        if not os.path.exists(asr_path) or not os.path.exists(pdc_path):
+            index.update(source, samples=[], loudness=None)
+            continue
+        start_time, start_cpu = time.time(), time.process_time()
         print("Processing files:")
         print(asr_path)
         print(pdc_path)
@@ -110,137 +411,520 @@ def process_samples():
         texts = []
         start_list = []
         end_list = []
+        begin_trim_list = []
+        end_trim_list = []
+        duration_list = []
+        quality_list = []
+
+        columns = load_columns(asr_path)
+
+        # words of recognized fragments or of segments targeting the duration window
+        ranges = fragment_ranges(columns, settings.MIN_CONF)
+        if settings.SEGMENTATION:
+            segments = segment_words(columns, min_span, max_span, settings.MIN_CONF,
+                                     settings.SEGMENT_MAX_GAP, settings.SEGMENT_MIN_SPLIT_GAP)
+        else:
+            segments = ranges
+        kept, transcribed = segments_yield(columns, ranges, min_span, max_span)
+        estimates[0] += kept
+        estimates[1] += segments_yield(columns, segments, min_span, max_span)[0]
+        estimates[2] += transcribed
+
+        words = [columns['vocabulary'][i] for i in columns['word_ids'].tolist()]
+        fragments = [(float(columns['start'][first]), float(columns['end'][last]),
+                      text if text is not None else ' '.join(words[first:last + 1]), (first, last, text))
+                     for first, last, text in segments]
+        kept_segments = []
+
+        samples, frame_rate = read_wav(pdc_path)
+        metrics, _, _ = quality_metrics(pdc_path, index[source].get('quality'))
+        n_silence = silence_frames(settings.SILENCE_START, frame_rate) + silence_frames(settings.SILENCE_END, frame_rate)
 
-        with open(asr_path, encoding='utf8') as f:
-            data = json.load(f)
-
-        start, end, text = [], [], []
-        for item in data:
-            if not item['text'] == '':
-                conf = [word['conf'] for word in item['result']]
-                if min(conf) >= settings.MIN_CONF:
-                    start.append(item['result'][0]['start'])
-                    end.append(item['result'][-1]['end'])
-                    text.append(item['text'])
-
-        dataframe = pd.DataFrame({'start': start, 'end': end, 'text': text})
-
-        wav_file = pydub.AudioSegment.from_file(file=pdc_path, format='wav')
-
-        samples_film = []
         samples_gain = []
         i = 1
-        for _, row in dataframe.iterrows():
-            start = row['start']
-            end = row['end']
-            sample = wav_file[(start * 1000):(end * 1000)]
+        for start, end, text, segment in fragments:
+            sample = slice_samples(samples, frame_rate, start * 1000, end * 1000)
 
             # Delete silence in the beginning and the end of a sample
-            begin_trim = detect_leading_silence(sample)
-            end_trim = detect_leading_silence(sample.reverse())
-            duration = len(sample)
-            sample_trim = sample[begin_trim:(duration - end_trim)]
-            sample_trim = pydub.AudioSegment.silent(duration=settings.SILENCE_START) + sample_trim + pydub.AudioSegment.silent(duration=settings.SILENCE_END)
+            begin_trim, end_trim = detect_silence(sample, frame_rate)
+            sample_trim = cut_sample(samples, frame_rate, start, end, begin_trim, end_trim)
+            n_frames = len(sample_trim) + n_silence
 
-            if settings.MIN_TIME < sample_trim.duration_seconds < settings.MAX_TIME:
+            if settings.MIN_TIME < n_frames / frame_rate < settings.MAX_TIME:
                 wav_name = 'PD%s-%s' % (str(source_id).zfill(3), str(i).zfill(4))
 
-                samples_film.append(sample_trim)
-                samples_gain.append(sample_trim.dBFS)
+                samples_gain.append(samples_dbfs(sample_trim, n_frames))
+                kept_segments.append(segment)
                 wav_names.append(wav_name)
-                texts.append(row['text'])
+                texts.append(text)
                 start_list.append(start)
                 end_list.append(end)
-                sum_time += sample_trim.duration_seconds
+                begin_trim_list.append(begin_trim)
+                end_trim_list.append(end_trim)
+                duration_list.append(n_frames / frame_rate)
+                quality_list.append(clip_quality(metrics, frame_rate, start, end))
                 i += 1
 
-        samples.append(samples_film)
+        kept_speech += speech_duration(columns, kept_segments)
         gain.append(samples_gain)
-        dataframe_list.append(pd.DataFrame({'name': wav_names, 'text': texts}))
+        snr, clipping, flatness = zip(*quality_list) if quality_list else ([], [], [])
+        dataframe_list.append(pd.DataFrame({'name': wav_names, 'text': texts, 'path': pdc_path,
+                                            'start': start_list, 'end': end_list,
+                                            'begin_trim': begin_trim_list, 'end_trim': end_trim_list,
+                                            'duration': duration_list,
+                                            'snr': snr, 'clipping': clipping, 'flatness': flatness}))
         source_id += 1
+        index.update(source, samples=wav_names, loudness=loudness_stats(samples_gain).to_dict(),
+                     status='process_samples')
+        profiler.add_file('process_samples', pdc_path, time.time() - start_time, time.process_time() - start_cpu,
+                          len(samples) / frame_rate)
+
+    index.save()
+
+    if estimates[2] > 0:
+        print('yield: %.1f of %.1f sec of transcribed speech kept (%.1f%%), estimated by word times: '
+              '%.1f%% without segmentation, %.1f%% with segmentation'
+              % (kept_speech, estimates[2], 100 * kept_speech / estimates[2],
+                 100 * estimates[0] / estimates[2], 100 * estimates[1] / estimates[2]))
+    return gain, dataframe_list
+
+
+def export_worker(task):
+    """
+    Cut samples of one input audio file, apply volume gain and write every sample immediately
+
+    The input audio file is memory-mapped, so a worker holds only the sample being written
+
+    :param task: (input .wav path, list of (name, start, end, begin_trim, end_trim, volume change))
+    :return: input .wav path, written audio (sec), processing time (sec), CPU time (sec)
+    """
+    path, rows = task
+    start_time, start_cpu = time.time(), time.thread_time()
+    samples, frame_rate = read_wav(path)
+    silence_start = np.zeros(silence_frames(settings.SILENCE_START, frame_rate), dtype=np.int16)
+    silence_end = np.zeros(silence_frames(settings.SILENCE_END, frame_rate), dtype=np.int16)
+    n_frames = 0
+    for name, start, end, begin_trim, end_trim, volume_change in rows:
+        sample = cut_sample(samples, frame_rate, start, end, begin_trim, end_trim)
+        sample = np.concatenate([silence_start, apply_gain(sample, volume_change), silence_end])
+        write_wav(os.path.join(settings.WAVS_DATA_PATH, '%s.wav' % name), sample, frame_rate)
+        n_frames += len(sample)
+    return path, n_frames / frame_rate, time.time() - start_time, time.thread_time() - start_cpu
+
+
+def export_samples(dataframe_list, gains, cache=None):
+    """
+    Cut samples again, apply volume gain and write samples by EXPORT_WORKERS threads or processes
+
+    Samples of every input audio file are split into tasks of EXPORT_CHUNK_SIZE samples,
+    tasks hold only cut positions, so memory in flight is bounded by one sample per worker
+
+    Write .wav to WAVS_DATA_PATH
+
+    :param dataframe_list: dataset file names and cut positions for every input audio file (from process_samples)
+    :param gains: volume change (dB) for every sample
+    :param cache: StageCache to skip input audio files with all samples written and to checkpoint written files
+    """
+    if not os.path.exists(settings.WAVS_DATA_PATH):
+        os.makedirs(settings.WAVS_DATA_PATH)
 
-    return samples, gain, dataframe_list
+    tasks = []
+    outputs = {}
+    for dataframe, samples_gain in zip(dataframe_list, gains):
+        if len(dataframe) == 0:
+            continue
+        path = dataframe['path'].iloc[0]
+        outputs[path] = [os.path.join(settings.WAVS_DATA_PATH, '%s.wav' % name) for name in dataframe['name']]
+        if cache is not None and cache.is_done(path, outputs[path]):
+            continue
+        rows = list(zip(dataframe['name'], dataframe['start'], dataframe['end'],
+                        dataframe['begin_trim'], dataframe['end_trim'], samples_gain))
+        for i in range(0, len(rows), settings.EXPORT_CHUNK_SIZE):
+            tasks.append((path, rows[i:i + settings.EXPORT_CHUNK_SIZE]))
+    if cache is not None:
+        cache.prune(list(outputs))
+
+    remaining = {}
+    for path, _ in tasks:
+        remaining[path] = remaining.get(path, 0) + 1
+
+    files = {}
+    for path, duration, elapsed, cpu in parallel_map(export_worker, tasks, settings.EXPORT_WORKERS,
+                                                     threads=settings.EXPORT_THREADS):
+        total = files.setdefault(path, [0.0, 0.0, 0.0])
+        total[0] += elapsed
+        total[1] += cpu
+        total[2] += duration
+        remaining[path] -= 1
+        if remaining[path] == 0:
+            profiler.add_file('export', path, *total)
+            if cache is not None:
+                cache.done(path, outputs[path])
+
+
+def preprocess_worker(paths):
+    """
+    Convert one audio file
+
+    :param paths: (input audio path, output .wav path)
+    :return: input audio path, audio duration (sec), processing time (sec), CPU time (sec)
+    """
+    src, des = paths
+    start_time, start_cpu = time.time(), time.process_time()
+    duration = convert_audio(src, des, settings.SAMPLE_RATE)
+    return src, duration, time.time() - start_time, time.process_time() - start_cpu
 
 
-def preprocess_audio(file_format):
+def preprocess_audio():
     """
-    Convert wav and mp3 files to wav mono with SAMPLE_RATE
+    Convert audio files of RAW_FORMATS to wav mono with SAMPLE_RATE
+
+    Files are converted by PREPROCESS_WORKERS processes, only new or changed files are processed
 
     Read .wav or .mp3 from RAW_DATA_PATH
 
-    Write .wav to INPUT_DATA_PATH
+    Write .wav to INPUT_DATA_PATH and corpus index to CORPUS_INDEX_PATH
+    """
+    cache = StageCache(shard_path(os.path.join(settings.CACHE_DATA_PATH, 'preprocess.json'), current_shard), {
+        'SAMPLE_RATE': settings.SAMPLE_RATE,
+    })
+
+    # the corpus index is rebuilt by one walk over RAW_DATA_PATH
+    index = corpus_index(build=True)
+    sources = {index[source]['raw']: source for source in index if index[source]['raw'] is not None}
+    input_paths = list(sources)
+    output_paths = {path: index[source]['input'] for path, source in sources.items()}
+
+    cache.prune(input_paths)
+    tasks = [(path, output_paths[path]) for path in input_paths if not cache.is_done(path, [output_paths[path]])]
+
+    total_duration = 0
+    start_time = time.time()
+    try:
+        for src, duration, elapsed, cpu in tqdm.tqdm(parallel_map(preprocess_worker, tasks,
+                                                                  settings.PREPROCESS_WORKERS), total=len(tasks)):
+            cache.done(src, [output_paths[src]])
+            index.update(sources[src], duration=duration, status='preprocess')
+            profiler.add_file('preprocess', src, elapsed, cpu, duration)
+            total_duration += duration
+            tqdm.tqdm.write('%s: %.1f sec of audio in %.2f sec' % (src, duration, elapsed))
+    finally:
+        cache.save()
+        index.save()
+
+    if tasks:
+        elapsed = time.time() - start_time
+        print('preprocessing: %.1f sec of audio in %.1f sec (%.1f audio sec per sec)'
+              % (total_duration, elapsed, total_duration / elapsed))
+
+
+# columns of samples tables (see process_samples)
+SAMPLES_COLUMNS = ['name', 'text', 'path', 'start', 'end', 'begin_trim', 'end_trim', 'duration', 'snr', 'clipping',
+                   'flatness', 'gain']
+
+
+def save_samples(path, dataframe_list, gain):
+    """
+    Write dataset file names, text labels, cut positions and volume of samples of all input audio files
+    to one .csv table (written to a temporary file and renamed)
+    """
+    import pandas as pd
+
+    samples = pd.concat([dataframe.assign(gain=samples_gain) for dataframe, samples_gain
+                         in zip(dataframe_list, gain)] or [pd.DataFrame(columns=SAMPLES_COLUMNS)], axis=0)
+    tmp_path = path + '.tmp'
+    samples.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
 
-    :param file_format: file format for reading from RAW_DATA_PATH
+
+def load_samples(path):
+    """
+    Read table of save_samples
+
+    :return: samples volume and dataset file names, text labels and cut positions for every input audio file
     """
-    assert file_format in ['wav', 'mp3']
+    import pandas as pd
 
-    input_paths = glob.glob(os.path.join(settings.RAW_DATA_PATH, '**', '*.%s' % file_format), recursive=True)
+    samples = pd.read_csv(path, float_precision='round_trip', keep_default_na=False)
+    dataframe_list = [dataframe.drop(columns='gain').reset_index(drop=True)
+                      for _, dataframe in samples.groupby('path', sort=False)]
+    gain = [dataframe['gain'].tolist() for _, dataframe in samples.groupby('path', sort=False)]
+    return gain, dataframe_list
 
-    output_paths = []
-    for path in input_paths:
-        local_path = os.path.relpath(path, settings.RAW_DATA_PATH)
-        local_path = local_path.replace('.%s' % file_format, '.wav')
-        output_paths.append(os.path.join(settings.INPUT_DATA_PATH, local_path))
 
-    for src, des in tqdm.tqdm(zip(input_paths, output_paths)):
-        if file_format == 'mp3':
-            sound = pydub.AudioSegment.from_mp3(src)
-        else:
-            sound = pydub.AudioSegment.from_wav(src)
-        sound = sound.set_channels(1)
-        sound = sound.set_frame_rate(settings.SAMPLE_RATE)
+def measure_samples():
+    """
+    Run process_samples and write its results to SAMPLES_PATH (a shard writes its own table)
+    """
+    gain, dataframe_list = process_samples()
+    save_samples(shard_path(settings.SAMPLES_PATH, current_shard), dataframe_list, gain)
 
-        dir_name = os.path.dirname(des)
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
 
-        sound.export(des, format="wav")
+def merge_shards(n_shards):
+    """
+    Merge corpus indexes and samples tables of n_shards shards into CORPUS_INDEX_PATH and SAMPLES_PATH
 
+    Sources cut into samples are numbered in the order of the merged index and samples are renamed
+    to PD###-####, so names are globally unique and equal to the names of a run without shards
 
-if __name__ == "__main__":
-    # Convert wav, mp3 files to wav mono
-    preprocess_audio('wav')
-    preprocess_audio('mp3')
+    :return: samples volume, dataset file names, text labels and cut positions for every input audio file
+    and RunningStats of samples volume of every input audio file (from the shard indexes)
+    """
+    shards = [(i, n_shards) for i in range(n_shards)]
+    missing = [shard_path(settings.SAMPLES_PATH, shard) for shard in shards
+               if not os.path.exists(shard_path(settings.SAMPLES_PATH, shard))]
+    if missing:
+        raise FileNotFoundError('shards are not processed to process_samples stage: %s' % ', '.join(missing))
+
+    index = CorpusIndex(settings.CORPUS_INDEX_PATH)
+    index.sources = {}
+    tables = {}
+    for shard in shards:
+        index.merge(CorpusIndex(shard_path(settings.CORPUS_INDEX_PATH, shard)))
+        for samples_gain, dataframe in zip(*load_samples(shard_path(settings.SAMPLES_PATH, shard))):
+            tables[dataframe['path'].iloc[0]] = samples_gain, dataframe
+
+    gain, dataframe_list, stats = [], [], []
+    source_id = 1
+    for source in index:
+        if index[source].get('loudness') is None:
+            continue
+        wav_names = ['PD%s-%s' % (str(source_id).zfill(3), str(i).zfill(4))
+                     for i in range(1, len(index[source]['samples']) + 1)]
+        index.update(source, samples=wav_names)
+        source_id += 1
+        if index[source]['input'] in tables:
+            samples_gain, dataframe = tables[index[source]['input']]
+            gain.append(samples_gain)
+            dataframe_list.append(dataframe.assign(name=wav_names))
+            stats.append(RunningStats.from_dict(index[source]['loudness']))
+
+    index.save()
+    save_samples(settings.SAMPLES_PATH, dataframe_list, gain)
+    print('merged %d shards: %d sources, %d samples'
+          % (n_shards, len(index), sum([len(dataframe) for dataframe in dataframe_list])))
+    return gain, dataframe_list, stats
+
+
+def normalize_samples():
+    """
+    Compute volume change of every sample of SAMPLES_PATH and write it to NORMALIZED_SAMPLES_PATH
+    (column gain is replaced by volume change)
 
-    # Predict text
-    automatic_speech_recognition()
+    After a sharded run the shards are merged first (see merge_shards), volume is normalized
+    by the merged per-source statistics
+    """
+    if merged_shards is not None:
+        gain, dataframe_list, stats = merge_shards(merged_shards)
+    else:
+        gain, dataframe_list = load_samples(settings.SAMPLES_PATH)
+        stats = None
+    save_samples(settings.NORMALIZED_SAMPLES_PATH, dataframe_list, normalization_gains(gain, stats))
 
-    # Predict punctuation
-    restore_punctuation()
 
-    # Cut samples
-    samples, gain, dataframe_list = process_samples()
+def write_samples():
+    """
+    Export samples of NORMALIZED_SAMPLES_PATH, every input audio file with all samples written is checkpointed
+    """
+    cache = StageCache(os.path.join(settings.CACHE_DATA_PATH, 'export.json'), {
+        'SAMPLES': file_hash(settings.NORMALIZED_SAMPLES_PATH),
+        'SILENCE_START': settings.SILENCE_START,
+        'SILENCE_END': settings.SILENCE_END,
+    })
+    gains, dataframe_list = load_samples(settings.NORMALIZED_SAMPLES_PATH)
+    try:
+        export_samples(dataframe_list, gains, cache)
+    finally:
+        cache.save()
+
+        index = corpus_index()
+        for source in index:
+            entry = cache.files.get(index[source]['input'])
+            if entry is not None and entry['hash'] is not None:
+                index.update(source, status='export')
+        index.save()
+
+
+def write_metadata():
+    """
+    Write cleaned text labels of NORMALIZED_SAMPLES_PATH to METADATA_PATH and split samples on train, val, test
 
-    # Normalize samples by volume
-    samples_norm = normalize_audio(samples, gain)
+    Dataset statistics of every input audio file are updated in DATASET_SUMMARY_PATH (see utils.utils.DatasetStats)
+    """
+    import pandas as pd
 
+    _, dataframe_list = load_samples(settings.NORMALIZED_SAMPLES_PATH)
     metadata = pd.concat(dataframe_list, axis=0)
     # Clean text
-    metadata['text'] = metadata['text'].apply(english_cleaner)
+    metadata['text'] = english_cleaner_series(metadata['text'])
     # Write metadata file
-    metadata.to_csv(settings.METADATA_PATH, sep='|', header=False, index=False)
+    metadata[['name', 'text']].to_csv(settings.METADATA_PATH, sep='|', header=False, index=False)
 
-    # Write samples
-    if not os.path.exists(settings.WAVS_DATA_PATH):
-        os.makedirs(settings.WAVS_DATA_PATH)
-    for sample, wav_name in zip([item for sublist in samples_norm for item in sublist], metadata['name'].to_list()):
-        sample.export(os.path.join(settings.WAVS_DATA_PATH, '%s.wav' % wav_name), format="wav")
+    # samples tables written before the duration column was added: durations of the written samples
+    if 'duration' not in metadata.columns:
+        metadata['duration'] = [wav_duration(os.path.join(settings.WAVS_DATA_PATH, '%s.wav' % name))
+                                for name in metadata['name']]
+    stats = DatasetStats(settings.DATASET_SUMMARY_PATH)
+    stats.update(metadata['path'], metadata['duration'], metadata['text'])
+    stats.prune(metadata['path'].unique())
+    stats.save()
+
+    write_filelists(metadata)
 
-    # Split samples on train, val, test
-    # Using format from https://github.com/NVIDIA/tacotron2
-    filelists = pd.read_csv(settings.METADATA_PATH, sep='|', header=None)
-    filelists[0] = filelists[0].apply(lambda x: 'DUMMY/%s.wav' % x)
 
-    train = filelists.sample(frac=settings.TRAIN_FRAC, random_state=0)
-    val_and_test = filelists.drop(train.index)
-    val = val_and_test.sample(frac=settings.VAL_FRAC/(1.0 - settings.TRAIN_FRAC), random_state=0)
-    test = val_and_test.drop(val.index)
+def write_filelists(metadata):
+    """
+    Split samples on train, val, test by TRAIN_FRAC, VAL_FRAC, TEST_FRAC of the total duration
+    and write filelists in the format of https://github.com/NVIDIA/tacotron2
+
+    With SPLIT_BY = 'source' all samples of an input audio file are in one subset
+    (samples are split by clips if there are fewer input audio files than subsets)
+
+    :param metadata: pandas.DataFrame with name, cleaned text, path and duration of every sample
+    """
+    import pandas as pd
+
+    fractions = [settings.TRAIN_FRAC, settings.VAL_FRAC, settings.TEST_FRAC]
+    groups, sources = pd.factorize(metadata['path'])
+    if settings.SPLIT_BY == 'clip' or len(sources) < sum([fraction > 0 for fraction in fractions]):
+        if settings.SPLIT_BY != 'clip':
+            print('split: %d input audio files for %d subsets, samples are split by clips'
+                  % (len(sources), sum([fraction > 0 for fraction in fractions])))
+        groups = None
+    subsets = split_by_duration(metadata['duration'].values, fractions, groups, settings.SPLIT_SEED)
 
     if not os.path.exists(settings.FILELISTS_PATH):
         os.makedirs(settings.FILELISTS_PATH)
 
-    train.to_csv(settings.TRAIN_PATH, sep='|', header=False, index=False)
-    val.to_csv(settings.VAL_PATH, sep='|', header=False, index=False)
-    test.to_csv(settings.TEST_PATH, sep='|', header=False, index=False)
+    filelists = pd.DataFrame({0: 'DUMMY/' + metadata['name'] + '.wav', 1: metadata['text']})
+    durations = metadata['duration'].values
+    for subset, (name, path, fraction) in enumerate(zip(['train', 'val', 'test'],
+                                                        [settings.TRAIN_PATH, settings.VAL_PATH, settings.TEST_PATH],
+                                                        fractions)):
+        mask = subsets == subset
+        share = np.sum(durations[mask]) / max(np.sum(durations), 1e-9)
+        filelists[mask].to_csv(path, sep='|', header=False, index=False)
+        print('split: %s %d samples, %.2f hours (%.1f%%), %d input audio files'
+              % (name, np.sum(mask), np.sum(durations[mask]) / 3600, 100 * share,
+                 len(pd.unique(metadata['path'].values[mask]))))
+        # a subset is far from its target if input audio files are few or long
+        if fraction > 0 and abs(share - fraction) > fraction / 2:
+            print('split: warning: %s is %.1f%% of the duration instead of %.1f%%, '
+                  'set SPLIT_BY = \'clip\' to split samples of input audio files' % (name, 100 * share, 100 * fraction))
+
+
+def write_dataset_stat():
+    """
+    Write statistics accumulated by the metadata stage to DATASET_STAT_PATH
 
-    dataset_stat(settings.WAVS_DATA_PATH, settings.METADATA_PATH, settings.DATASET_STAT_PATH)
+    With verify_stat (or without accumulated statistics) statistics are recomputed from samples of WAVS_DATA_PATH
+    and METADATA_PATH, differences from the accumulated statistics are reported
+    """
+    summary = DatasetStats(settings.DATASET_SUMMARY_PATH).total \
+        if os.path.exists(settings.DATASET_SUMMARY_PATH) else None
+    if summary is None or verify_stat:
+        scanned = scan_dataset(settings.WAVS_DATA_PATH, settings.METADATA_PATH)
+        if summary is not None:
+            differences = summary.differences(scanned)
+            print('dataset statistics: %s' % ('verified' if not differences else
+                                              'differ from the samples on disk: %s' % ', '.join(differences)))
+        summary = scanned
+    dataset_stat(settings.WAVS_DATA_PATH, settings.METADATA_PATH, settings.DATASET_STAT_PATH, summary)
+
+
+# pipeline stages in the order of running, results of every stage are written to disk,
+# so any range of stages can be run again
+STAGES = {
+    'preprocess': preprocess_audio,  # convert wav, mp3 files to wav mono
+    'quality': analyze_quality,  # measure audio quality to skip bad regions in ASR
+    'asr': automatic_speech_recognition,  # predict text
+    'punctuation': restore_punctuation,  # predict punctuation
+    'process_samples': measure_samples,  # measure samples volume
+    'normalization': normalize_samples,  # normalize samples by volume
+    'export': write_samples,  # cut and write samples
+    'metadata': write_metadata,  # clean text, write metadata and train, val, test filelists
+    'dataset_stat': write_dataset_stat,  # write dataset statistics
+}
+
+
+# stages run by every shard of a sharded run, the rest of stages run once after merging the shards
+SHARD_STAGES = ['preprocess', 'quality', 'asr', 'punctuation', 'process_samples']
+
+
+def select_stages(first_stage, last_stage, shard=None, merge=None):
+    """
+    Names of stages from first_stage to last_stage, ValueError if the stages can not be run
+    """
+    names = list(STAGES)
+    if names.index(first_stage) > names.index(last_stage):
+        raise ValueError('stage %s runs after stage %s' % (first_stage, last_stage))
+    stages = names[names.index(first_stage):names.index(last_stage) + 1]
+    if shard is not None and not set(stages) <= set(SHARD_STAGES):
+        raise ValueError('shards run stages %s only' % ', '.join(SHARD_STAGES))
+    if merge is not None and 'normalization' not in stages:
+        raise ValueError('shards are merged by the normalization stage')
+    return stages
+
+
+def main(first_stage='preprocess', last_stage='dataset_stat', shard=None, merge=None, verify=False):
+    """
+    Run stages from first_stage to last_stage and write profile of the run
+
+    Preprocess, ASR, punctuation and export stages checkpoint every processed file,
+    so an interrupted run continues from the last processed file
+
+    Sharded run over a shared data folder: every shard (i, n) runs SHARD_STAGES for its part of the sources
+    with its own corpus index, manifests, samples table and profile, then one run with merge=n
+    merges the shards in the normalization stage and runs the rest of stages
+
+    :param shard: (i, n) to run shard i of n shards
+    :param merge: number of shards to merge
+    :param verify: recompute dataset statistics from disk in the dataset_stat stage
+    """
+    global current_shard, merged_shards, verify_stat
+
+    stages = select_stages(first_stage, last_stage, shard, merge)
+    current_shard, merged_shards, verify_stat = shard, merge, verify
+
+    try:
+        for name in stages:
+            with profiler.stage(name):
+                STAGES[name]()
+    finally:
+        profiler.save(shard_path(settings.PROFILE_PATH, shard), shard_path(settings.PROFILE_CSV_PATH, shard))
+
+
+def parse_shard(value):
+    """
+    Parse shard argument i/N (0 <= i < N)
+    """
+    try:
+        i, n = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be i/N, e.g. 0/4')
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError('shard index must be in 0..N-1')
+    return i, n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Audio automatic labeling pipeline')
+    parser.add_argument('--from', dest='first_stage', choices=list(STAGES),
+                        help='first stage to run (default: preprocess, normalization with --merge)')
+    parser.add_argument('--to', dest='last_stage', choices=list(STAGES),
+                        help='last stage to run (default: dataset_stat, process_samples with --shard)')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help='run shard i of N shards (stages %s)' % ', '.join(SHARD_STAGES))
+    parser.add_argument('--merge', type=int, metavar='N', help='merge N shards and run the rest of stages')
+    parser.add_argument('--verify-stat', action='store_true',
+                        help='recompute dataset statistics from the samples on disk and compare')
+    args = parser.parse_args()
+    if args.shard is not None and args.merge is not None:
+        parser.error('--shard and --merge are run by separate processes')
+    first_stage = args.first_stage or ('normalization' if args.merge is not None else 'preprocess')
+    last_stage = args.last_stage or (SHARD_STAGES[-1] if args.shard is not None else 'dataset_stat')
+    try:
+        select_stages(first_stage, last_stage, args.shard, args.merge)
+    except ValueError as e:
+        parser.error(str(e))
+    main(first_stage, last_stage, args.shard, args.merge, args.verify_stat)
@@ -3,17 +3,31 @@ import sys
 import wave
 import json
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
-import settings
+from utils.audio_utils import find_silence_gaps
 from utils.text_cleaners import russian_restore_punc_cleaner, english_restore_punc_cleaner
 
-from vosk import Model, KaldiRecognizer
-from vosk import SetLogLevel
-SetLogLevel(-1)
+# vosk, torch, transformers and recasepunc are imported by the models which use them,
+# so stages and worker processes without these models start fast and small
 
-sys.path.insert(0, settings.PUNC_MODEL)
-from recasepunc import CasePuncPredictor
-from recasepunc import WordpieceTokenizer
+
+def load_recasepunc(dir_model):
+    """
+    Import recasepunc module of the punctuation model folder
+
+    recasepunc checkpoint is pickled with WordpieceTokenizer of the __main__ module, so it is added there
+    """
+    if dir_model not in sys.path:
+        sys.path.insert(0, dir_model)
+    import recasepunc
+    from transformers import logging
+    logging.set_verbosity_error()
+
+    main_module = sys.modules['__main__']
+    if not hasattr(main_module, 'WordpieceTokenizer'):
+        main_module.WordpieceTokenizer = recasepunc.WordpieceTokenizer
+    return recasepunc
 
 
 class SpeechToText:
@@ -48,20 +62,30 @@ class SpeechToText:
                   "unpack as '" + dir_model + "' in the current folder.")
             exit(1)
 
+        from vosk import Model, SetLogLevel
+        SetLogLevel(-1)
         self.model = Model(dir_model)
 
-    def predict(self, dir_wav):
+    def recognizer(self, frame_rate):
+        """
+        New recognizer with word times for a stream of mono 16-bit PCM (see streaming.py)
+        """
+        from vosk import KaldiRecognizer
+        rec = KaldiRecognizer(self.model, frame_rate)
+        rec.SetWords(True)
+        return rec
+
+    def predict(self, dir_wav, progress=True):
         wf = wave.open(dir_wav, "rb")
 
         if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
             print("Audio file" + dir_wav + "must be WAV format mono PCM.")
             exit(1)
 
-        rec = KaldiRecognizer(self.model, wf.getframerate())
-        rec.SetWords(True)
+        rec = self.recognizer(wf.getframerate())
 
         result = []
-        with tqdm.tqdm(total=wf.getnframes()) as pbar:
+        with tqdm.tqdm(total=wf.getnframes(), disable=not progress) as pbar:
             while True:
                 data = wf.readframes(1000)
                 if len(data) == 0:
@@ -75,6 +99,114 @@ class SpeechToText:
         rec.FinalResult()
         return result
 
+    def predict_chunked(self, dir_wav, chunk_duration, overlap=2.0, search_duration=10.0, workers=1):
+        """
+        Split a long .wav file at silence gaps into overlapping chunks, recognize chunks in parallel
+        and merge the results with global start, end of every word
+
+        Every chunk owns the words whose center lies between its split points,
+        words recognized in the overlap by the neighbouring chunk are dropped
+
+        :param dir_wav: path to .wav file
+        :param chunk_duration: target chunk duration (sec)
+        :param overlap: audio added to both sides of every chunk (sec)
+        :param search_duration: half width of the window to search a silence gap around chunk border (sec)
+        :param workers: number of threads sharing the model
+        :return: text fragments in the same format as predict
+        """
+        points = find_silence_gaps(dir_wav, chunk_duration, search_duration)
+        if len(points) <= 2:
+            return self.predict(dir_wav, progress=False)
+
+        owned = [(begin, end, 0, points[-1]) for begin, end in zip(points[:-1], points[1:])]
+        return self._predict_owned(dir_wav, owned, overlap, workers)
+
+    def predict_regions(self, dir_wav, regions, workers=1, chunk_duration=0, overlap=2.0, search_duration=10.0):
+        """
+        Recognize only the given regions of a .wav file (e.g. without regions of bad quality, see utils.quality),
+        the rest of the file is never passed to the recognizer
+
+        Regions longer than chunk_duration are split at silence gaps into overlapping chunks as in predict_chunked,
+        chunks never extend beyond their region
+
+        :param dir_wav: path to .wav file
+        :param regions: list of (begin, end) audio frames
+        :param workers: number of threads sharing the model
+        :param chunk_duration: target chunk duration (sec), 0 to recognize every region whole
+        :param overlap: audio added to both sides of every chunk within its region (sec)
+        :param search_duration: half width of the window to search a silence gap around chunk border (sec)
+        :return: text fragments in the same format as predict with start, end of every word in the whole file
+        """
+        owned = []
+        for begin, end in regions:
+            points = [begin, end]
+            if chunk_duration > 0:
+                points = find_silence_gaps(dir_wav, chunk_duration, search_duration, begin=begin, end=end)
+            owned.extend([(point, next_point, begin, end) for point, next_point in zip(points[:-1], points[1:])])
+
+        return self._predict_owned(dir_wav, owned, overlap, workers)
+
+    def _predict_owned(self, dir_wav, owned, overlap, workers):
+        """
+        Recognize overlapping chunks in parallel and merge the results with global start, end of every word
+
+        Every chunk owns the words whose center lies between its split points,
+        words recognized in the overlap by the neighbouring chunk are dropped
+
+        :param owned: list of (begin, end, region begin, region end) audio frames of every chunk, the overlap
+        is added to both sides of a chunk within its region
+        """
+        with wave.open(dir_wav, "rb") as wf:
+            rate = wf.getframerate()
+        pad = int(overlap * rate)
+        bounds = [(max(region_begin, begin - pad), min(region_end, end + pad))
+                  for begin, end, region_begin, region_end in owned]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(lambda b: self._recognize_chunk(dir_wav, *b), bounds))
+
+        result = []
+        for (begin, end, _, _), (chunk_begin, _), fragments in zip(owned, bounds, chunks):
+            offset = chunk_begin / rate
+            for fragment in fragments:
+                words = []
+                for word in fragment.get('result', []):
+                    word['start'] = round(word['start'] + offset, 6)
+                    word['end'] = round(word['end'] + offset, 6)
+                    if begin <= (word['start'] + word['end']) / 2 * rate < end:
+                        words.append(word)
+                if words:
+                    result.append({'result': words, 'text': ' '.join([word['word'] for word in words])})
+
+        return result
+
+    def _recognize_chunk(self, dir_wav, begin, end):
+        wf = wave.open(dir_wav, "rb")
+
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
+            print("Audio file" + dir_wav + "must be WAV format mono PCM.")
+            exit(1)
+
+        rec = self.recognizer(wf.getframerate())
+
+        result = []
+        wf.setpos(begin)
+        position = begin
+        while position < end:
+            data = wf.readframes(min(1000, end - position))
+            if len(data) == 0:
+                break
+            position += len(data) // 2
+            if rec.AcceptWaveform(data):
+                result.append(json.loads(rec.Result()))
+            else:
+                rec.PartialResult()
+
+        # words at the end of a chunk are finalized here, the next chunk starts inside them
+        result.append(json.loads(rec.FinalResult()))
+        wf.close()
+        return result
+
 
 class PunctuationPredictor:
     """
@@ -103,45 +235,161 @@ class PunctuationPredictor:
     ]
     """
 
-    def __init__(self, dir_model=None, lang='en'):
-        self.model = CasePuncPredictor(os.path.join(dir_model, 'checkpoint'), lang=lang)
+    def __init__(self, dir_model=None, lang='en', model=None, threads=None):
+        """
+        :param threads: torch intra-op threads of the process (e.g. cores per worker process), None to keep
+        """
+        if threads is not None:
+            import torch
+            torch.set_num_threads(threads)
+        if model is None:
+            model = load_recasepunc(dir_model).CasePuncPredictor(os.path.join(dir_model, 'checkpoint'), lang=lang)
+        self.model = model
         self.lang = lang
 
     def predict(self, json_data):
-        texts_ = []
-        word_sums = []
+        tokens_ = self._tokenize(json_data)
+        return self._restore(json_data, tokens_, self.model.predict(tokens_, lambda x: x[1]))
 
-        for item_ in json_data:
-            texts_.append(item_['text'])
-            word_sums.append(len(item_['text'].split(' ')))
+    def predict_batch(self, json_list, batch_size=16, names=None):
+        """
+        Predict punctuation and capital letters for many .json files at once
+
+        Token windows are built by CasePuncPredictor.predict itself: predict of every file is run with the network
+        replaced by a recorder of its inputs, recorded windows of all files are packed into batches of batch_size
+        windows for one forward pass (only windows of equal length share a batch, no padding is added),
+        then predict of every file is run again with the network replaced by the batched scores.
+        So windows, skipped tokens and labels are the same as predict for every file
+
+        :param json_list: list of .json data
+        :param batch_size: number of token windows in one forward pass
+        :param names: names of files for error messages
+        :return: list of .json data with restored punctuation
+        """
+        import torch
+
+        tokens_list = [self._tokenize(json_data) for json_data in json_list]
+        network = self.model.model
+        n_punc, n_case = len(self.model.rev_punc), len(self.model.rev_case)
+
+        def recorder(windows):
+            def forward(x):
+                windows.append(x)
+                return torch.zeros(x.shape + (n_punc,)), torch.zeros(x.shape + (n_case,))
+            return forward
+
+        def replayer(scores):
+            scores = iter(scores)
+            return lambda x: next(scores)
 
-        text_ = ' '.join(texts_)
-        tokens_ = list(enumerate(self.model.tokenize(text_)))
+        try:
+            windows_list = [[] for _ in json_list]
+            for tokens_, windows in zip(tokens_list, windows_list):
+                self.model.model = recorder(windows)
+                for _ in self.model.predict(tokens_, lambda x: x[1]):
+                    pass
 
-        results = ''
-        for token, case_label, punc_label in self.model.predict(tokens_, lambda x: x[1]):
+            # windows of all files grouped by shape, predict pads all windows to max_length
+            shapes = {}
+            for f, windows in enumerate(windows_list):
+                for k, x in enumerate(windows):
+                    shapes.setdefault(tuple(x.shape), []).append((f, k))
+
+            scores_list = [[None] * len(windows) for windows in windows_list]
+            for _, group in sorted(shapes.items()):
+                for i in range(0, len(group), batch_size):
+                    batch = group[i:i + batch_size]
+                    with torch.no_grad():
+                        punc_scores, case_scores = network(torch.cat([windows_list[f][k] for f, k in batch]))
+                    for j, (f, k) in enumerate(batch):
+                        scores_list[f][k] = punc_scores[j:j + 1], case_scores[j:j + 1]
+
+            results = []
+            for f, (json_data, tokens_, scores) in enumerate(zip(json_list, tokens_list, scores_list)):
+                self.model.model = replayer(scores)
+                try:
+                    results.append(self._restore(json_data, tokens_, list(self.model.predict(tokens_, lambda x: x[1]))))
+                except ValueError as e:
+                    raise ValueError('%s: %s' % (names[f] if names is not None else 'file %d' % f, e)) from e
+        finally:
+            self.model.model = network
+        return results
+
+    def _tokenize(self, json_data):
+        text_ = ' '.join([item_['text'] for item_ in json_data])
+        return list(enumerate(self.model.tokenize(text_)))
+
+    def _restore(self, json_data, tokens_, predictions):
+        """
+        Apply predicted labels to tokens and replace words of .json data with them
+
+        Every token is mapped to its word by the token index (distinct words are tokenized once
+        to count their tokens, [CLS] and [SEP] added by CasePuncPredictor.tokenize belong to no word),
+        so one linear pass rebuilds all words and a wrong number of tokens raises ValueError
+        instead of shifting the following words
+
+        :param json_data: .json data
+        :param tokens_: tokens of the text of json_data, list of (index, token)
+        :param predictions: iterable of (token, case label, punctuation label), token is (index, token)
+        """
+        words = [word for item_ in json_data if not item_['text'] == '' for word in item_['result']]
+
+        config = self.model.config
+        n_tokens = {}
+        word_tokens = []
+        for i, word in enumerate(words):
+            if word['word'] not in n_tokens:
+                n_tokens[word['word']] = len(config.tokenizer.tokenize(word['word']))
+            word_tokens.extend([i] * n_tokens[word['word']])
+
+        ids = config.tokenizer.convert_tokens_to_ids([token for _, token in tokens_])
+        positions = [i for i, id_ in enumerate(ids) if id_ != config.cls_token_id and id_ != config.sep_token_id]
+        if len(positions) != len(word_tokens):
+            raise ValueError('%d tokens of text for %d tokens of %d words'
+                             % (len(positions), len(word_tokens), len(words)))
+        token_words = [None] * len(ids)
+        for position, i in zip(positions, word_tokens):
+            token_words[position] = i
+
+        pieces = [[] for _ in words]
+        n_predictions = 0
+        for token, case_label, punc_label in predictions:
+            if token[0] >= len(token_words):
+                raise ValueError('token %d "%s" is out of %d tokens of %d words'
+                                 % (token[0], token[1], len(token_words), len(words)))
+            if token_words[token[0]] is None:
+                continue
             prediction = self.model.map_punc_label(
                 self.model.map_case_label(token[1], case_label), punc_label
             )
             if token[1][0] != '#':
-                results = results + ' ' + prediction
-            else:
-                results = results + prediction
+                prediction = ' ' + prediction
+            pieces[token_words[token[0]]].append(prediction)
+            n_predictions += 1
+
+        if n_predictions != len(word_tokens):
+            raise ValueError('%d tokens are predicted for %d tokens of %d words'
+                             % (n_predictions, len(word_tokens), len(words)))
 
-        results = results[1:]
         if self.lang == 'ru':
-            results = russian_restore_punc_cleaner(results)
+            cleaner = russian_restore_punc_cleaner
         elif self.lang == 'en':
-            results = english_restore_punc_cleaner(results)
-        result_words = results.split(' ')
+            cleaner = english_restore_punc_cleaner
+        else:
+            cleaner = None
 
-        for i in range(len(json_data)):
-            if not json_data[i]['text'] == '':
-                words = []
-                for j in range(len(json_data[i]['result'])):
-                    word = result_words.pop(0)
-                    json_data[i]['result'][j]['word'] = word
-                    words.append(word)
-                json_data[i]['text'] = ' '.join(words)
+        for word, word_pieces in zip(words, pieces):
+            text = ''.join(word_pieces)
+            text = text[1:] if text.startswith(' ') else text
+            # cleaners join tokens separated by spaces, tokens which are not joined stay in one word
+            if ' ' in text:
+                if cleaner is not None:
+                    text = cleaner(text)
+                text = ''.join(text.split(' '))
+            word['word'] = text
+
+        for item_ in json_data:
+            if not item_['text'] == '':
+                item_['text'] = ' '.join([word['word'] for word in item_['result']])
 
         return json_data
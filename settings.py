@@ -5,13 +5,25 @@ import os
 Data structure names
 """
 RAW_DATA_PATH = os.path.join('data', 'raw')  # raw audio files (.wav, .mp3)
+RAW_FORMATS = ['wav', 'mp3']  # raw audio file formats
 INPUT_DATA_PATH = os.path.join('data', 'input')  # processed audio files (.wav)
-ASR_DATA_PATH = os.path.join('data', 'asr')  # predicted texts (.json)
-PUNC_DATA_PATH = os.path.join('data', 'punc')  # predicted text with punctuation and capital letters (.json)
+ASR_DATA_PATH = os.path.join('data', 'asr')  # predicted texts (.json or .npz)
+PUNC_DATA_PATH = os.path.join('data', 'punc')  # predicted text with punctuation and capital letters (.json or .npz)
+QUALITY_DATA_PATH = os.path.join('data', 'quality')  # framewise audio quality metrics (.npz)
+TRANSCRIPT_FORMAT = 'json'  # format of predicted texts: 'json' or 'npz' (compact columnar, see utils/transcripts.py)
 WAVS_DATA_PATH = os.path.join('data', 'wavs')  # dataset samples (.wav)
 METADATA_PATH = os.path.join('data', 'metadata.csv')  # dataset metadata
 FILELISTS_PATH = os.path.join('data', 'filelists')  # train, val, test samples (https://github.com/NVIDIA/tacotron2)
 DATASET_STAT_PATH = os.path.join('data', 'dataset_stat.txt')  # dataset statistics
+CACHE_DATA_PATH = os.path.join('data', 'cache')  # manifests of processed files for every stage (.json)
+STREAM_DATA_PATH = os.path.join('data', 'live')  # recordings, samples tables and metadata of live streams
+CORPUS_INDEX_PATH = os.path.join(CACHE_DATA_PATH, 'corpus.json')  # outputs, duration and status of every source
+SAMPLES_PATH = os.path.join(CACHE_DATA_PATH, 'samples.csv')  # cut positions and volume of samples
+NORMALIZED_SAMPLES_PATH = os.path.join(CACHE_DATA_PATH, 'normalized_samples.csv')  # cut positions and volume change
+DATASET_SUMMARY_PATH = os.path.join(CACHE_DATA_PATH, 'dataset_stat.json')  # statistics accumulated by sources
+PROFILE_PATH = os.path.join('data', 'profile.json')  # time, memory and real-time factor of every stage and file
+PROFILE_CSV_PATH = os.path.join('data', 'profile.csv')  # the same profile as a table
+PROFILE_DATA_PATH = os.path.join('data', 'profile')  # cProfile dumps of every stage (.prof)
 
 """
 Train, val, test split
@@ -19,10 +31,12 @@ Train, val, test split
 TRAIN_PATH = os.path.join(FILELISTS_PATH, 'ljs_audio_text_train_filelist.txt')  # train names
 VAL_PATH = os.path.join(FILELISTS_PATH, 'ljs_audio_text_val_filelist.txt')  # val names
 TEST_PATH = os.path.join(FILELISTS_PATH, 'ljs_audio_text_test_filelist.txt')  # test names
-TRAIN_FRAC = 0.95  # train fraction
-VAL_FRAC = 0.05  # val fraction
-TEST_FRAC = 0.0  # test fraction
+TRAIN_FRAC = 0.95  # train fraction of the total duration
+VAL_FRAC = 0.05  # val fraction of the total duration
+TEST_FRAC = 0.0  # test fraction of the total duration
 assert TRAIN_FRAC + VAL_FRAC + TEST_FRAC == 1.0
+SPLIT_BY = 'source'  # 'source': all samples of an input audio file are in one subset, 'clip': samples are split
+SPLIT_SEED = 0  # random seed of the split
 
 """
 Vosk models
@@ -33,6 +47,57 @@ LANG = 'en'  # language
 ASR_MODEL = os.path.join('vosk_models', 'vosk-model-en-us-0.22')  # automatic speech recognition model
 PUNC_MODEL = os.path.join('vosk_models', 'vosk-recasepunc-en-0.22')  # restore punctuation model
 
+"""
+Audio quality gating (utils/quality.py)
+"""
+# regions of input audio close to the noise floor (long pauses, noise and music beds), clipped or noise-like
+# are not passed to speech recognition (opt-in, quality metrics of samples are computed anyway)
+QUALITY_GATING = False
+QUALITY_FRAME_DURATION = 0.05  # frame of energy, SNR, clipping and spectral flatness (sec)
+QUALITY_BLOCK_DURATION = 5.0  # block to estimate the noise floor for SNR (sec)
+QUALITY_MIN_SNR = 6.0  # frames closer to the noise floor are bad (dB)
+QUALITY_MAX_CLIPPING = 0.01  # frames with a larger fraction of samples at full scale are bad
+QUALITY_MAX_FLATNESS = 0.35  # frames with flatter spectrum and louder than QUALITY_SILENCE_THRESHOLD are bad
+QUALITY_SILENCE_THRESHOLD = -60.0  # dBFS
+QUALITY_MIN_SKIP = 2.0  # minimal skipped region (sec), shorter runs of bad frames are recognized
+QUALITY_PAD = 0.25  # audio kept on both sides of a skipped region (sec)
+
+"""
+Parallel processing
+"""
+PREPROCESS_WORKERS = os.cpu_count()  # audio conversion processes
+
+ASR_WORKERS = 1  # speech recognition processes (every process loads its own copy of ASR_MODEL)
+
+# long files are split at silence gaps into overlapping chunks recognized in parallel threads
+ASR_CHUNK_DURATION = 0  # target chunk duration (sec), 0 to recognize every file as a whole
+ASR_CHUNK_OVERLAP = 2.0  # audio added to both sides of every chunk (sec)
+# half width of the window to search a silence gap at chunk border (sec, <= ASR_CHUNK_DURATION / 2)
+ASR_CHUNK_SEARCH = 10.0
+ASR_CHUNK_WORKERS = 4  # threads recognizing chunks of one file
+
+PUNC_WORKERS = 1  # punctuation processes (every process loads its own copy of PUNC_MODEL)
+PUNC_THREADS = 0  # torch threads of every punctuation process, 0 to share the CPU cores between PUNC_WORKERS
+PUNC_BATCH_FILES = 64  # .json files loaded for punctuation prediction at once
+PUNC_BATCH_SIZE = 16  # token windows in one forward pass of the punctuation model
+
+EXPORT_WORKERS = os.cpu_count()  # sample writers
+EXPORT_THREADS = True  # writers are threads (export is I/O-bound on fast disks) or processes
+EXPORT_CHUNK_SIZE = 256  # samples of one input audio file written by one task
+
+"""
+Streaming (streaming.py)
+"""
+STREAM_BLOCK_DURATION = 0.1  # audio read and passed to the recognizer at once (sec)
+STREAM_MAX_UTTERANCE = 15.0  # fragment is finalized after this time without a pause (sec), bounds the latency
+STREAM_QUEUE_SIZE = 16  # recognized fragments waiting for punctuation and export
+STREAM_IDLE_TIMEOUT = 10.0  # a growing file is finished when it does not grow for this time (sec)
+
+"""
+Profiling
+"""
+PROFILE_STAGES = False  # write cProfile dump of every stage to PROFILE_DATA_PATH (slows down the main process)
+
 """
 Dataset settings
 """
@@ -42,6 +107,11 @@ MIN_CONF = 1.0  # minimal confidence level for text fragment (mean for all words
 MIN_TIME = 1.11  # minimal audio sample duration (sec)
 MAX_TIME = 8.0  # maximal audio sample duration (sec)
 
+# merge short fragments and split long ones at pauses between words to fit MIN_TIME - MAX_TIME
+SEGMENTATION = True
+SEGMENT_MAX_GAP = 1.0  # maximal pause inside merged fragments (sec)
+SEGMENT_MIN_SPLIT_GAP = 0.1  # minimal pause between words to split a fragment (sec)
+
 # https://github.com/NVIDIA/tacotron2/issues/269
 # Add silence at the end audio.
 # The recommended size of silence is 5 hop_size.
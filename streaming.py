@@ -0,0 +1,340 @@
+"""
+Label live audio as it arrives
+
+Audio is read from a growing .wav or raw PCM file, a pipe (stdin) or a local socket,
+recognized incrementally, every finalized fragment is punctuated, cut, written as a sample
+and appended to the metadata immediately
+
+Pipe and socket audio is raw mono 16-bit PCM with SAMPLE_RATE, e.g.
+`ffmpeg -i https://radio.example/stream -f s16le -ac 1 -ar 22050 - | python streaming.py --stdin --name RADIO`
+
+Write to STREAM_DATA_PATH:
+    <name>.wav - recording of the received audio
+    <name>.csv - samples table (the format of SAMPLES_PATH with latency of every sample)
+    <name>_metadata.csv - text labels in LJSpeech format
+Write samples .wav to WAVS_DATA_PATH
+
+Samples are not normalized by volume: the whole stream is unknown yet. Samples table and recording
+keep everything needed to normalize and export samples again with the batch stages
+"""
+import os
+import sys
+import csv
+import json
+import time
+import wave
+import bisect
+import struct
+import asyncio
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import settings
+from utils.audio_utils import detect_silence, slice_samples, duration_ms, silence_frames, samples_dbfs, write_wav
+from utils.text_cleaners import english_cleaner
+
+SAMPLES_COLUMNS = ['name', 'text', 'path', 'start', 'end', 'begin_trim', 'end_trim', 'gain', 'latency']
+
+
+async def read_growing_file(f, block_size, poll_interval=0.1, idle_timeout=10.0):
+    """
+    Read a file which is still being written by blocks from the current position (after the .wav header,
+    see _skip_wav_header), the file is finished when it does not grow for idle_timeout
+
+    :param f: file opened in binary mode, closed at the end
+    :param block_size: bytes in one block
+    """
+    with f:
+        idle = 0.0
+        while True:
+            data = f.read(block_size)
+            if data:
+                idle = 0.0
+                yield data
+            elif idle >= idle_timeout:
+                return
+            else:
+                await asyncio.sleep(poll_interval)
+                idle += poll_interval
+
+
+async def _skip_wav_header(f, poll_interval=0.1, idle_timeout=10.0):
+    """
+    Read .wav header of a growing file up to the data chunk, waiting for the header to be written
+    (the data chunk size of a growing file is not final, so the wave module can not be used)
+
+    :param f: file opened in binary mode
+    :return: frame rate (Hz)
+    """
+    async def read_exactly(n):
+        data = b''
+        idle = 0.0
+        while len(data) < n:
+            block = f.read(n - len(data))
+            if not block:
+                if idle >= idle_timeout:
+                    raise ValueError('%s: incomplete .wav header' % f.name)
+                await asyncio.sleep(poll_interval)
+                idle += poll_interval
+            data += block
+        return data
+
+    riff, _, wave_id = struct.unpack('<4sI4s', await read_exactly(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError('%s: not a .wav file' % f.name)
+    frame_rate = None
+    while True:
+        chunk_id, chunk_size = struct.unpack('<4sI', await read_exactly(8))
+        if chunk_id == b'data':
+            if frame_rate is None:
+                raise ValueError('%s: no fmt chunk before the data chunk' % f.name)
+            return frame_rate
+        if chunk_id == b'fmt ':
+            fmt = await read_exactly(chunk_size + chunk_size % 2)
+            channels, frame_rate, _, _, sample_width = struct.unpack('<HIIHH', fmt[2:16])
+            if channels != 1 or sample_width != 16:
+                raise ValueError('%s: only mono 16-bit PCM .wav is supported' % f.name)
+        else:
+            await read_exactly(chunk_size + chunk_size % 2)
+
+
+async def read_stream(reader, block_size):
+    """
+    Read asyncio.StreamReader (pipe or socket) by blocks until the end of stream
+    """
+    while True:
+        data = await reader.read(block_size)
+        if not data:
+            return
+        yield data
+
+
+class StreamLabeler:
+    """
+    Recognize, punctuate, cut and write samples of one live audio stream
+
+    Recognition and punctuation run in their own threads, so reading audio, recognition
+    and export of the previous fragments overlap. Recognized fragments wait in a queue of STREAM_QUEUE_SIZE
+    together with the number of frames received when they were finalized, when it is full, reading stops until a fragment is exported (audio is buffered by the pipe or the file)
+
+    Latency of a sample is the time from receiving the last audio frame of its fragment to writing the sample.
+    It is bounded by the endpoint of the recognizer: a fragment without a pause is finalized
+    after STREAM_MAX_UTTERANCE
+    """
+
+    def __init__(self, name, frame_rate, stt, punc_predictor):
+        """
+        :param name: stream name, samples are named <name>-0001, <name>-0002, ...
+        :param frame_rate: frame rate of the stream (Hz)
+        :param stt: models.SpeechToText
+        :param punc_predictor: models.PunctuationPredictor
+        """
+        self.name = name
+        self.frame_rate = frame_rate
+        self.stt = stt
+        self.punc_predictor = punc_predictor
+        self.asr_executor = ThreadPoolExecutor(1)
+        self.punc_executor = ThreadPoolExecutor(1)
+
+        # received audio not exported yet starts at frame buffer_start of the stream
+        self.buffer = bytearray()
+        self.buffer_start = 0
+        self.n_frames = 0
+        # (number of received frames, time of receiving) of every block
+        self.arrivals = []
+
+        self.n_samples = 0
+        self.latencies = []
+
+    async def run(self, blocks):
+        """
+        Label stream of PCM blocks (async iterator of bytes)
+        """
+        if not os.path.exists(settings.STREAM_DATA_PATH):
+            os.makedirs(settings.STREAM_DATA_PATH)
+        if not os.path.exists(settings.WAVS_DATA_PATH):
+            os.makedirs(settings.WAVS_DATA_PATH)
+
+        self.recording_path = os.path.join(settings.STREAM_DATA_PATH, self.name + '.wav')
+        samples_path = os.path.join(settings.STREAM_DATA_PATH, self.name + '.csv')
+        metadata_path = os.path.join(settings.STREAM_DATA_PATH, self.name + '_metadata.csv')
+
+        start_time = time.time()
+        fragments = asyncio.Queue(maxsize=settings.STREAM_QUEUE_SIZE)
+        with contextlib.closing(wave.open(self.recording_path, 'wb')) as recording, \
+                open(samples_path, 'w', newline='') as samples_file, \
+                open(metadata_path, 'w', newline='') as metadata_file:
+            recording.setnchannels(1)
+            recording.setsampwidth(2)
+            recording.setframerate(self.frame_rate)
+            samples_writer = csv.writer(samples_file)
+            samples_writer.writerow(SAMPLES_COLUMNS)
+
+            await asyncio.gather(self._recognize(blocks, recording, fragments),
+                                 self._export(fragments, samples_writer, samples_file, metadata_file))
+
+        self.asr_executor.shutdown()
+        self.punc_executor.shutdown()
+        self._print_summary(time.time() - start_time)
+
+    async def _recognize(self, blocks, recording, fragments):
+        loop = asyncio.get_running_loop()
+        rec = self.stt.recognizer(self.frame_rate)
+        max_utterance = int(settings.STREAM_MAX_UTTERANCE * self.frame_rate)
+        last_final = 0
+        remainder = b''
+        try:
+            async for data in blocks:
+                data = remainder + data
+                data, remainder = data[:len(data) - len(data) % 2], data[len(data) - len(data) % 2:]
+                if not data:
+                    continue
+                self.buffer += data
+                self.n_frames += len(data) // 2
+                self.arrivals.append((self.n_frames, time.time()))
+                recording.writeframes(data)
+
+                if await loop.run_in_executor(self.asr_executor, rec.AcceptWaveform, bytes(data)):
+                    last_final = self.n_frames
+                    await fragments.put((json.loads(rec.Result()), last_final))
+                elif self.n_frames - last_final > max_utterance:
+                    # no pause for too long: finalize the fragment (word times keep counting from the stream start)
+                    last_final = self.n_frames
+                    result = await loop.run_in_executor(self.asr_executor, rec.FinalResult)
+                    await fragments.put((json.loads(result), last_final))
+
+            result = await loop.run_in_executor(self.asr_executor, rec.FinalResult)
+            await fragments.put((json.loads(result), self.n_frames))
+        finally:
+            await fragments.put(None)
+
+    async def _export(self, fragments, samples_writer, samples_file, metadata_file):
+        loop = asyncio.get_running_loop()
+        n_silence = silence_frames(settings.SILENCE_START, self.frame_rate) + \
+            silence_frames(settings.SILENCE_END, self.frame_rate)
+        silence_start = np.zeros(silence_frames(settings.SILENCE_START, self.frame_rate), dtype=np.int16)
+        silence_end = np.zeros(silence_frames(settings.SILENCE_END, self.frame_rate), dtype=np.int16)
+
+        while True:
+            item = await fragments.get()
+            if item is None:
+                return
+            fragment, final_frame = item
+            words = fragment.get('result', [])
+            if not words:
+                # music or silence: the recognizer is done with the audio up to the finalization
+                self._drop_buffer(final_frame)
+                continue
+            start, end = words[0]['start'], words[-1]['end']
+
+            # positions are computed from the stream start as for an audio file (see labeling.cut_sample),
+            # the next fragments start after this one
+            begin = int(start * 1000 * (self.frame_rate / 1000.0)) - self.buffer_start
+            stop = int(end * 1000 * (self.frame_rate / 1000.0)) - self.buffer_start
+            sample = np.frombuffer(bytes(self.buffer[max(begin, 0) * 2:max(stop, 0) * 2]), dtype=np.int16)
+            self._drop_buffer(stop + self.buffer_start)
+
+            if not fragment.get('text') or min([word['conf'] for word in words]) < settings.MIN_CONF:
+                continue
+            [fragment] = await loop.run_in_executor(self.punc_executor, self.punc_predictor.predict, [fragment])
+
+            begin_trim, end_trim = detect_silence(sample, self.frame_rate)
+            sample = slice_samples(sample, self.frame_rate, begin_trim,
+                                   duration_ms(sample, self.frame_rate) - end_trim)
+            if not settings.MIN_TIME < (len(sample) + n_silence) / self.frame_rate < settings.MAX_TIME:
+                continue
+
+            self.n_samples += 1
+            wav_name = '%s-%s' % (self.name, str(self.n_samples).zfill(4))
+            write_wav(os.path.join(settings.WAVS_DATA_PATH, '%s.wav' % wav_name),
+                      np.concatenate([silence_start, sample, silence_end]), self.frame_rate)
+
+            latency = time.time() - self._arrival_time(int(end * self.frame_rate))
+            self.latencies.append(latency)
+            samples_writer.writerow([wav_name, fragment['text'], self.recording_path, start, end,
+                                     begin_trim, end_trim, samples_dbfs(sample, len(sample) + n_silence), latency])
+            samples_file.flush()
+            metadata_file.write('%s|%s\n' % (wav_name, english_cleaner(fragment['text'])))
+            metadata_file.flush()
+            print('%s: %.1f sec, latency %.2f sec: %s' % (wav_name, end - start, latency, fragment['text']))
+
+    def _drop_buffer(self, frame):
+        """
+        Forget received audio before frame of the stream
+        """
+        frame = min(frame, self.n_frames)
+        if frame > self.buffer_start:
+            del self.buffer[:(frame - self.buffer_start) * 2]
+            self.buffer_start = frame
+            self.arrivals = self.arrivals[max(bisect.bisect_left(self.arrivals, (frame, 0.0)) - 1, 0):]
+
+    def _arrival_time(self, frame):
+        i = bisect.bisect_left(self.arrivals, (frame, 0.0))
+        return self.arrivals[min(i, len(self.arrivals) - 1)][1]
+
+    def _print_summary(self, elapsed):
+        duration = self.n_frames / self.frame_rate
+        print('%s: %.1f sec of audio in %.1f sec, %d samples' % (self.name, duration, elapsed, self.n_samples))
+        if self.latencies:
+            latencies = np.array(self.latencies)
+            print('latency: mean %.2f sec, p50 %.2f sec, p95 %.2f sec, max %.2f sec'
+                  % (latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95), latencies.max()))
+
+
+def block_bytes(frame_rate):
+    """
+    :return: bytes of mono 16-bit PCM read at once (STREAM_BLOCK_DURATION)
+    """
+    return 2 * int(settings.STREAM_BLOCK_DURATION * frame_rate)
+
+
+async def open_source(args):
+    """
+    :return: async iterator of PCM blocks, frame rate of the stream (Hz)
+    """
+    frame_rate = args.rate
+    if args.file:
+        f = open(args.file, 'rb')
+        if args.file.lower().endswith('.wav'):
+            try:
+                frame_rate = await _skip_wav_header(f, idle_timeout=settings.STREAM_IDLE_TIMEOUT)
+            except BaseException:
+                f.close()
+                raise
+        return read_growing_file(f, block_bytes(frame_rate), idle_timeout=settings.STREAM_IDLE_TIMEOUT), frame_rate
+    if args.stdin:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    elif args.socket:
+        reader, _ = await asyncio.open_unix_connection(args.socket)
+    else:
+        host, port = args.tcp.rsplit(':', 1)
+        reader, _ = await asyncio.open_connection(host, int(port))
+    return read_stream(reader, block_bytes(frame_rate)), frame_rate
+
+
+async def main(args):
+    from models import SpeechToText, PunctuationPredictor
+
+    blocks, frame_rate = await open_source(args)
+    stt = SpeechToText(dir_model=settings.ASR_MODEL, lang=settings.LANG)
+    punc_predictor = PunctuationPredictor(settings.PUNC_MODEL, lang=settings.LANG)
+
+    labeler = StreamLabeler(args.name, frame_rate, stt, punc_predictor)
+    await labeler.run(blocks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Label live audio as it arrives')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help='growing .wav (mono 16-bit) or raw PCM file')
+    source.add_argument('--stdin', action='store_true', help='raw PCM from stdin')
+    source.add_argument('--socket', help='raw PCM from a unix socket')
+    source.add_argument('--tcp', help='raw PCM from a local TCP socket (host:port)')
+    parser.add_argument('--rate', type=int, default=settings.SAMPLE_RATE, help='frame rate of raw PCM (Hz)')
+    parser.add_argument('--name', default='LIVE', help='stream name, prefix of sample names')
+    asyncio.run(main(parser.parse_args()))
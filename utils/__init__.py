@@ -1,3 +1,10 @@
-from .audio_utils import detect_leading_silence, normalize_audio
-from .text_cleaners import russian_cleaner, english_cleaner, russian_restore_punc_cleaner, english_restore_punc_cleaner
-from .utils import dataset_stat
+from .audio_utils import detect_leading_silence, detect_silence, normalize_audio, normalization_gains, find_silence_gaps, convert_audio, \
+    read_wav_header, read_wav, write_wav, duration_ms, slice_samples, silence_frames, samples_dbfs, apply_gain, RunningStats, loudness_stats
+from .text_cleaners import russian_cleaner, english_cleaner, english_cleaner_series, \
+    russian_restore_punc_cleaner, english_restore_punc_cleaner
+from .utils import dataset_stat, parallel_map, wav_duration, scan_dataset, DatasetSummary, DatasetStats, source_summaries
+from .cache import StageCache, file_hash
+from .corpus import CorpusIndex
+from .transcripts import save_transcript, load_transcript, load_columns, convert_transcripts
+from .profiling import Profiler
+from .quality import frame_metrics, bad_frames, skip_regions, keep_regions, clip_quality, save_metrics, load_metrics
@@ -1,5 +1,14 @@
+import os
+import math
+import wave
+import struct
+import contextlib
+import subprocess
 import numpy as np
 
+import pydub
+from pydub.utils import audioop, mediainfo_json
+
 
 def detect_leading_silence(sound, silence_threshold=-30.0, chunk_size=10):
     """
@@ -20,18 +29,429 @@ def detect_leading_silence(sound, silence_threshold=-30.0, chunk_size=10):
     return trim_ms
 
 
-def normalize_audio(samples, gain):
+def rms_to_dbfs(rms, max_possible_amplitude=32768.0):
+    """
+    Convert integer rms to dBFS exactly as pydub.AudioSegment.dBFS does
+    """
+    if not rms:
+        return -float('infinity')
+    return 20 * math.log(rms / max_possible_amplitude, 10)
+
+
+def min_sound_rms(threshold, max_possible_amplitude=32768.0):
+    """
+    Minimal integer rms with dBFS >= threshold (rms_to_dbfs is monotonic, so dBFS comparisons become integer ones)
+    """
+    if threshold == -float('infinity'):
+        return 0
+    rms = int(math.ceil(max_possible_amplitude * 10 ** (threshold / 20)))
+    rms = min(max(rms, 1), int(max_possible_amplitude) + 1)
+    while rms > 1 and rms_to_dbfs(rms - 1, max_possible_amplitude) >= threshold:
+        rms -= 1
+    while rms <= max_possible_amplitude and rms_to_dbfs(rms, max_possible_amplitude) < threshold:
+        rms += 1
+    return rms
+
+
+def detect_silence(samples, frame_rate, silence_threshold=-30.0, chunk_size=10, block_size=32):
+    """
+        samples is np.array of mono audio samples (e.g. np.frombuffer(sound.raw_data, dtype=np.int16))
+        frame_rate in Hz
+        silence_threshold in dB relative to the sound volume
+        chunk_size in ms
+
+        rms of chunks is computed for blocks of block_size chunks at once from the cumulative sum of squares,
+        chunks at the end are taken from the end of samples, so the result is equal to
+        (detect_leading_silence(sound), detect_leading_silence(sound.reverse())) without copying audio
+
+        returns silence duration in the beginning and in the end (ms)
+    """
+    assert chunk_size > 0
+
+    n = len(samples)
+    max_possible_amplitude = 2 ** (samples.dtype.itemsize * 8) / 2
+    duration = round(1000 * (n / frame_rate))  # len(sound)
+
+    # audioop.rms: sqrt of mean square truncated to integer (sums of squares are exact in float64)
+    samples = samples.astype(np.float64)
+    rms = int(math.sqrt(np.dot(samples, samples) / n)) if n else 0
+    min_rms = min_sound_rms(rms_to_dbfs(rms, max_possible_amplitude) + silence_threshold, max_possible_amplitude)
+
+    # chunk positions as pydub.AudioSegment slicing computes them, frames after the end are padded with zeros
+    chunk_ms = np.arange(0, duration, chunk_size)
+    begin = (np.minimum(chunk_ms, duration) * (frame_rate / 1000.0)).astype(np.int64)
+    end = (np.minimum(chunk_ms + chunk_size, duration) * (frame_rate / 1000.0)).astype(np.int64)
+    count = np.where(begin < n, end - begin, 0)
+
+    def first_sound(lower, upper):
+        for k in range(0, len(chunk_ms), block_size):
+            lo, hi, cnt = lower[k:k + block_size], upper[k:k + block_size], count[k:k + block_size]
+            offset = lo.min()
+            squares = np.zeros(hi.max() - offset + 1)
+            np.cumsum(np.square(samples[offset:hi.max()]), out=squares[1:])
+            sums = squares[hi - offset] - squares[lo - offset]
+            chunks_rms = np.zeros(len(cnt), dtype=np.int64)
+            chunks_rms[cnt > 0] = np.sqrt(sums[cnt > 0] / cnt[cnt > 0]).astype(np.int64)
+            sound = np.flatnonzero(chunks_rms >= min_rms)
+            if len(sound):
+                return int(chunk_ms[k + sound[0]])
+        return len(chunk_ms) * chunk_size
+
+    leading = first_sound(np.minimum(begin, n), np.minimum(end, n))
+    trailing = first_sound(np.maximum(n - end, 0), np.maximum(n - begin, 0))
+    return leading, trailing
+
+
+class RunningStats:
+    """
+    Count, mean and population std of a stream of values (Welford)
+
+    Statistics of parts of values are merged exactly as of the concatenated values (Chan et al.),
+    so they can be collected by several workers or shards and merged later
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2  # sum of squared differences from the mean
+
+    def update(self, values):
+        """
+        Add a batch of values
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return self
+        mean = np.mean(values)
+        return self.merge(RunningStats(len(values), float(mean), float(np.sum(np.square(values - mean)))))
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else float('nan')
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['count'], data['mean'], data['m2'])
+
+
+def loudness_stats(gains):
+    """
+    RunningStats of samples volume (dBFS) of one file, silent samples (-inf dBFS) are skipped
+    """
+    gains = np.asarray(gains, dtype=np.float64)
+    return RunningStats().update(gains[np.isfinite(gains)])
+
+
+def normalization_gains(gain, stats=None):
+    """
+    Volume change (dB) for every sample to rescale samples volume of every file to common mean and std
+
+    Files without samples do not change the common mean and std. Volume of a file with equal samples volume
+    (e.g. one sample) is only shifted to the common mean, silent samples are not changed
+
+    :param gain: samples volume (dBFS) for every file
+    :param stats: RunningStats of samples volume for every file (e.g. merged from several workers),
+    computed from gain if None
+    :return: volume change (dB) for every sample of every file
+    """
+    if stats is None:
+        stats = [loudness_stats(gains) for gains in gain]
+
     # Calculate mean and std gain for every file
-    means = []
-    stds = []
-    for gains in gain:
-        means.append(np.mean(gains))
-        stds.append(np.std(gains))
+    means = [s.mean for s in stats if s.count]
+    stds = [s.std for s in stats if s.count]
+    mean_means = np.mean(means) if means else 0.0
+    mean_stds = np.mean(stds) if stds else 0.0
 
     # Rescale gain to common mean and std
+    volume_changes = []
+    for gains, s in zip(gain, stats):
+        gains = np.asarray(gains, dtype=np.float64)
+        z_scores = (gains - s.mean) / s.std if s.std > 0 else np.zeros(len(gains))
+        changes = -(gains - (mean_stds * z_scores + mean_means))
+        changes[~np.isfinite(gains)] = 0.0
+        volume_changes.append(changes.tolist())
+
+    return volume_changes
+
+
+def normalize_audio(samples, gain):
+    volume_changes = normalization_gains(gain)
+
     samples_norm = []
-    for samples_film, mean, std in zip(samples, means, stds):
-        samples_norm.append(
-            [s - (s.dBFS - (np.mean(stds) * ((s.dBFS - mean) / std) + np.mean(means))) for s in samples_film])
+    for samples_film, changes in zip(samples, volume_changes):
+        samples_norm.append([s.apply_gain(change) for s, change in zip(samples_film, changes)])
 
     return samples_norm
+
+
+def find_silence_gaps(dir_wav, chunk_duration, search_duration=10.0, frame_duration=10, begin=0, end=None):
+    """
+    Find points to split a long mono 16-bit .wav file (or its region from begin to end) into chunks
+    of about chunk_duration
+
+    Every split point is the center of the quietest frame within search_duration around the chunk border,
+    only the search windows are read from the file
+
+    :param dir_wav: path to .wav file
+    :param chunk_duration: target chunk duration (sec)
+    :param search_duration: half width of the search window (sec), at most half of chunk_duration
+    :param frame_duration: energy frame duration (ms)
+    :param begin: first frame of the region
+    :param end: end frame of the region, None for the end of the file
+    :return: split points in frames including begin and end (0 and the number of frames of the file)
+    """
+    # the search window of the next border must start after the previous split point
+    search_duration = min(search_duration, chunk_duration / 2)
+
+    with contextlib.closing(wave.open(dir_wav, 'rb')) as wf:
+        rate = wf.getframerate()
+        n_frames = wf.getnframes() if end is None else end
+        chunk = int(chunk_duration * rate)
+        search = int(search_duration * rate)
+        frame = max(1, int(frame_duration * rate / 1000))
+
+        points = [begin]
+        while n_frames - points[-1] > chunk + search:
+            begin = points[-1] + chunk - search
+            wf.setpos(begin)
+            window = np.frombuffer(wf.readframes(2 * search), dtype=np.int16).astype(np.float64)
+            n = len(window) // frame
+            energy = np.square(window[:n * frame]).reshape(n, frame).mean(axis=1)
+            points.append(begin + int(np.argmin(energy)) * frame + frame // 2)
+        points.append(n_frames)
+
+    return points
+
+
+def convert_audio(src, des, sample_rate, block_size=65536):
+    """
+    Convert audio file to .wav mono with sample_rate, reading, converting and writing by blocks of frames
+
+    16-bit PCM mono or stereo .wav files (also WAVE_FORMAT_EXTENSIBLE) are read from the data chunk,
+    other mono or stereo formats are decoded to 16-bit PCM by ffmpeg into a pipe. Downmix and resampling are
+    the same as in pydub set_channels(1), set_frame_rate (resampler state is kept between blocks), other .wav
+    files (e.g. float, 24-bit) and files with more than 2 channels (e.g. 5.1) are converted in memory with pydub
+
+    The output is written to a temporary file and renamed when complete, so an interrupted conversion
+    never leaves a truncated .wav file
+
+    :param src: input audio file
+    :param des: output .wav file
+    :param sample_rate: output sample rate (Hz)
+    :param block_size: frames in one block
+    :return: audio duration (sec)
+    """
+    dir_name = os.path.dirname(des)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+
+    tmp_path = des + '.tmp'
+
+    def convert_in_memory(sound):
+        sound = sound.set_channels(1)
+        sound = sound.set_frame_rate(sample_rate)
+        sound.export(tmp_path, format="wav")
+        os.replace(tmp_path, des)
+        return sound.duration_seconds
+
+    process = None
+    if src.lower().endswith('.wav'):
+        fmt, offset, data_size = read_wav_header(src)
+        channels, rate = fmt[1], fmt[2]
+        if fmt[0] not in (1, 0xFFFE) or fmt[5] != 16 or channels > 2:
+            return convert_in_memory(pydub.AudioSegment.from_wav(src))
+        stream = open(src, 'rb')
+        stream.seek(offset)
+        remaining = data_size - data_size % (2 * channels)
+
+        def read(n):
+            nonlocal remaining
+            data = stream.read(min(n * 2 * channels, remaining))
+            remaining -= len(data)
+            return data
+    else:
+        streams = [s for s in mediainfo_json(src)['streams'] if s['codec_type'] == 'audio']
+        if not streams:
+            raise ValueError('%s: no audio stream found' % src)
+        channels, rate = int(streams[0]['channels']), int(streams[0]['sample_rate'])
+        if channels > 2:
+            return convert_in_memory(pydub.AudioSegment.from_file(src))
+        process = subprocess.Popen([pydub.AudioSegment.converter, '-nostdin', '-i', src, '-vn',
+                                    '-acodec', 'pcm_s16le', '-f', 's16le', '-'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        stream = process.stdout
+        read = lambda n: stream.read(n * 2 * channels)
+
+    n_frames = 0
+    state = None
+    with contextlib.closing(wave.open(tmp_path, 'wb')) as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(sample_rate)
+        while True:
+            data = read(block_size)
+            if len(data) == 0:
+                break
+            n_frames += len(data) // (2 * channels)
+            if channels == 2:
+                data = audioop.tomono(data, 2, 0.5, 0.5)
+            if rate != sample_rate:
+                data, state = audioop.ratecv(data, 2, 1, rate, sample_rate, state)
+            out.writeframes(data)
+    stream.close()
+
+    if process is not None and process.wait() != 0:
+        raise RuntimeError('%s: decoding failed, ffmpeg returned error code %d' % (src, process.returncode))
+    os.replace(tmp_path, des)
+
+    return n_frames / rate
+
+
+def read_wav_header(path):
+    """
+    Parse the fmt chunk and find the data chunk of .wav file (also WAVE_FORMAT_EXTENSIBLE and float files,
+    which are rejected by the wave module)
+
+    :param path: path to .wav file
+    :return: (format tag, channels, frame rate, byte rate, block align, bits per sample), data offset (bytes),
+    data size (bytes)
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError('%s: not a RIFF/WAVE file' % path)
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError('%s: no data chunk' % path)
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(chunk_size - 16 + chunk_size % 2, 1)
+            elif chunk_id == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+    if fmt is None:
+        raise ValueError('%s: no fmt chunk' % path)
+    # data size of streamed .wav files may be unknown
+    return fmt, offset, min(chunk_size, file_size - offset)
+
+
+def read_wav(path):
+    """
+    Memory-map samples of mono 16-bit PCM .wav file
+
+    :param path: path to .wav file
+    :return: read-only np.memmap of np.int16 samples, frame rate (Hz)
+    """
+    fmt, offset, data_size = read_wav_header(path)
+    if fmt[0] not in (1, 0xFFFE) or fmt[1] != 1 or fmt[5] != 16:
+        raise ValueError('%s: audio file must be WAV format mono 16-bit PCM' % path)
+
+    n_frames = data_size // 2
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.int16), fmt[2]
+    return np.memmap(path, dtype='<i2', mode='r', offset=offset, shape=(n_frames,)), fmt[2]
+
+
+def write_wav(path, samples, frame_rate):
+    """
+    Write mono 16-bit PCM .wav file
+
+    :param path: path to .wav file
+    :param samples: np.array of np.int16 samples
+    :param frame_rate: frame rate (Hz)
+    """
+    with contextlib.closing(wave.open(path, 'wb')) as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(frame_rate)
+        f.writeframes(samples.astype('<i2', copy=False).tobytes())
+
+
+def duration_ms(samples, frame_rate):
+    """
+    Duration (ms) rounded in the same way as len(pydub.AudioSegment)
+    """
+    return round(1000 * (len(samples) / frame_rate))
+
+
+def slice_samples(samples, frame_rate, start, end):
+    """
+    Samples between start and end (ms) selected in the same way as pydub.AudioSegment[start:end]
+
+    :return: view of samples (copy only if frames after the end are padded with zeros)
+    """
+    duration = duration_ms(samples, frame_rate)
+
+    def position(val):
+        val = min(val, duration)
+        if val < 0:
+            val = duration - abs(val)
+        return int(val * (frame_rate / 1000.0))
+
+    begin, end = position(start), position(end)
+    data = samples[begin:end]
+
+    missing_frames = (end - begin) - len(data)
+    if missing_frames > 0 and len(data):
+        if missing_frames > 2 * (frame_rate / 1000.0):
+            raise ValueError('%d missing frames, never fill in more than 2 ms with silence' % missing_frames)
+        data = np.concatenate([data, np.zeros(missing_frames, dtype=samples.dtype)])
+    return data
+
+
+def silence_frames(duration, frame_rate):
+    """
+    Number of frames of pydub.AudioSegment.silent(duration) appended to audio with frame_rate >= 11025 Hz
+    """
+    silence = pydub.AudioSegment.silent(duration=duration).set_frame_rate(frame_rate)
+    return int(silence.frame_count())
+
+
+def samples_dbfs(samples, n_frames=None):
+    """
+    dBFS of samples as pydub.AudioSegment.dBFS computes it
+
+    :param samples: np.array of np.int16 samples
+    :param n_frames: number of frames if samples are padded with zeros
+    """
+    n_frames = len(samples) if n_frames is None else n_frames
+    samples = samples.astype(np.float64)
+    rms = int(math.sqrt(np.dot(samples, samples) / n_frames)) if n_frames else 0
+    return rms_to_dbfs(rms)
+
+
+def apply_gain(samples, volume_change):
+    """
+    Change volume of np.int16 samples in the same way as pydub.AudioSegment.apply_gain (audioop.mul)
+
+    :param samples: np.array of np.int16 samples
+    :param volume_change: volume change (dB)
+    """
+    values = samples * (10 ** (float(volume_change) / 20))
+    values = np.where(values > 32767, 32767, np.where(values < -32768 + 1.0, -32768, values))
+    return np.floor(values).astype(np.int16)
@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    SHA-1 of the file content read by blocks
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class StageCache:
+    """
+    Manifest of the files processed by one pipeline stage
+
+    Every input file is keyed by its content hash and the stage settings,
+    so a stage processes only new or changed files and removes outputs of deleted files.
+    The hash is recomputed only if the size or modification time of the file has changed
+
+    Every processed file is appended to a journal (<manifest>.log, one .json line per file) immediately,
+    so an interrupted run resumes from the last processed file. save() writes the manifest
+    to a temporary file, renames it and removes the journal
+
+    Manifest in .json format
+    {
+        "settings": {
+            "SAMPLE_RATE": 22050
+        },
+        "files": {
+            "data/input/file1.wav": {
+                "size": 1024,
+                "mtime": 1650000000000000000,
+                "hash": "da39a3ee5e6b4b0d3255bfef95601890afd80709",
+                "outputs": ["data/asr/file1.json"]
+            }
+        }
+    }
+    """
+
+    def __init__(self, path, stage_settings):
+        self.path = path
+        self.settings = stage_settings
+        self.files = {}
+        self.hashes = {}
+        self.journal_path = path + '.log'
+        self.journal = None
+
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                manifest = json.load(f)
+            self.files = manifest['files']
+            self._check_settings(manifest['settings'], self.files.values())
+
+        if os.path.exists(self.journal_path):
+            self._replay_journal()
+
+    def _check_settings(self, stage_settings, entries):
+        # outputs made with other settings are outdated, but are kept to be overwritten or pruned
+        if stage_settings != self.settings:
+            for entry in entries:
+                entry['hash'] = None
+
+    def _replay_journal(self):
+        with open(self.journal_path, encoding='utf8') as f:
+            lines = f.read().split('\n')
+        try:
+            stage_settings = json.loads(lines[0])['settings']
+        except ValueError:
+            return
+        entries = {}
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line is incomplete if the process was killed while writing it
+                continue
+            entries[entry.pop('input')] = entry
+        self._check_settings(stage_settings, entries.values())
+        self.files.update(entries)
+
+    def _stat(self, input_path):
+        stat = os.stat(input_path)
+        entry = self.files.get(input_path)
+        if entry is not None and entry['hash'] is not None \
+                and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            content_hash = entry['hash']
+        else:
+            content_hash = file_hash(input_path)
+        self.hashes[input_path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+        return content_hash
+
+    def is_done(self, input_path, output_paths):
+        """
+        Check that input file was processed with the same content and settings and all outputs exist
+        """
+        content_hash = self._stat(input_path)
+        entry = self.files.get(input_path)
+        if entry is None or entry['hash'] != content_hash:
+            return False
+        return all([os.path.exists(path) for path in output_paths])
+
+    def done(self, input_path, output_paths):
+        """
+        Mark input file as processed
+        """
+        if input_path not in self.hashes:
+            self._stat(input_path)
+        size, mtime, content_hash = self.hashes[input_path]
+        self.files[input_path] = {'size': size, 'mtime': mtime, 'hash': content_hash, 'outputs': output_paths}
+
+        if self.journal is None:
+            dir_name = os.path.dirname(self.path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name, exist_ok=True)
+            if os.path.exists(self.journal_path):
+                # replayed entries are already in self.files, start a new journal from the current state
+                self._write_manifest()
+                os.remove(self.journal_path)
+            self.journal = open(self.journal_path, 'w', encoding='utf8')
+            self.journal.write(json.dumps({'settings': self.settings}, ensure_ascii=False) + '\n')
+        self.journal.write(json.dumps(dict(self.files[input_path], input=input_path), ensure_ascii=False) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def prune(self, input_paths):
+        """
+        Remove outputs of input files which were deleted
+
+        :param input_paths: all current input files of the stage
+        """
+        input_paths = set(input_paths)
+        for path in [path for path in self.files if path not in input_paths]:
+            for output_path in self.files[path]['outputs']:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            del self.files[path]
+
+    def _write_manifest(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'settings': self.settings, 'files': self.files}, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        self._write_manifest()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
@@ -0,0 +1,132 @@
+import os
+import json
+import hashlib
+
+
+class CorpusIndex:
+    """
+    Index of the corpus: every source audio file with paths of its outputs of every stage, duration and status
+
+    The index is built by one walk over the raw audio folder, stages look up paths of a source in the index,
+    so outputs of different stages are always paired by source and never by position in sorted file lists
+
+    Index in .json format
+    {
+        "file3/file31": {
+            "raw": "data/raw/file3/file31.mp3",
+            "input": "data/input/file3/file31.wav",
+            "asr": "data/asr/file3/file31.json",
+            "punc": "data/punc/file3/file31.json",
+            "quality": "data/quality/file3/file31.npz",
+            "duration": 900.0,
+            "skipped": 120.0,
+            "status": "punctuation",
+            "samples": ["PD002-0001", "PD002-0002"],
+            "loudness": {"count": 2, "mean": -24.1, "m2": 3.5}
+        }
+    }
+
+    status is the last stage completed for the source, skipped is audio not passed to speech recognition (sec),
+    samples are dataset file names cut from the source, loudness is utils.audio_utils.RunningStats
+    of samples volume (null if the source was not cut into samples)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                self.sources = json.load(f)
+
+    def build(self, raw_dir, raw_formats, input_dir, asr_dir, punc_dir, transcript_format, quality_dir=None):
+        """
+        Add new sources and remove deleted ones, info of existing sources is kept
+
+        Sources are files of raw_formats in raw_dir, if there are no raw files, sources are .wav files in input_dir
+
+        :return: self
+        """
+        raw_paths = walk_files(raw_dir, raw_formats)
+        if raw_paths:
+            local_paths = {os.path.splitext(os.path.relpath(path, raw_dir))[0]: path for path in raw_paths}
+            if len(local_paths) < len(raw_paths):
+                names = [os.path.splitext(os.path.relpath(path, raw_dir))[0] for path in raw_paths]
+                duplicates = sorted(set([name for name in names if names.count(name) > 1]))
+                raise ValueError('%s: raw files with the same name and different formats: %s'
+                                 % (raw_dir, ', '.join(duplicates)))
+        else:
+            local_paths = {os.path.splitext(os.path.relpath(path, input_dir))[0]: None
+                           for path in walk_files(input_dir, ['wav'])}
+
+        sources = {}
+        for source in sorted(local_paths):
+            entry = self.sources.get(source, {'duration': None, 'status': None, 'samples': []})
+            entry.update({
+                'raw': local_paths[source],
+                'input': os.path.join(input_dir, source + '.wav'),
+                'asr': os.path.join(asr_dir, '%s.%s' % (source, transcript_format)),
+                'punc': os.path.join(punc_dir, '%s.%s' % (source, transcript_format)),
+            })
+            if quality_dir is not None:
+                entry['quality'] = os.path.join(quality_dir, source + '.npz')
+            sources[source] = entry
+        self.sources = sources
+        return self
+
+    def shard(self, i, n):
+        """
+        Keep only sources of shard i of n shards (0 <= i < n)
+
+        Sources are assigned to shards by MD5 of their names, so the partition is the same in every process
+        and a source stays in its shard when other sources are added or removed
+
+        :return: self
+        """
+        self.sources = {source: entry for source, entry in self.sources.items()
+                        if int(hashlib.md5(source.encode('utf8')).hexdigest(), 16) % n == i}
+        return self
+
+    def merge(self, other):
+        """
+        Add sources of other index (e.g. of a shard), sources stay sorted by name as after build
+
+        :return: self
+        """
+        sources = dict(self.sources)
+        sources.update(other.sources)
+        self.sources = {source: sources[source] for source in sorted(sources)}
+        return self
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, source):
+        return self.sources[source]
+
+    def update(self, source, **fields):
+        self.sources[source].update(fields)
+
+    def save(self):
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.sources, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def walk_files(dir_name, formats):
+    """
+    Sorted paths of all files with extensions of formats in dir_name and its subfolders
+    """
+    paths = []
+    for root, _, files in os.walk(dir_name):
+        for name in files:
+            if os.path.splitext(name)[1][1:].lower() in formats:
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
@@ -0,0 +1,143 @@
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import contextlib
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    Peak resident set size of the current process and of the largest finished child process (MB)
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def cpu_time():
+    """
+    CPU time of the current process and its finished child processes (sec)
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def real_time_factor(wall_time, audio_seconds):
+    return wall_time / audio_seconds if audio_seconds else None
+
+
+class Profiler:
+    """
+    Collect wall time, CPU time, peak RSS, processed audio and real-time factor (wall time / audio time)
+    of pipeline stages and of every file processed by a stage
+
+    Report in .json format
+    {
+        "stages": [
+            {
+                "stage": "asr",
+                "wall_time": 120.5,
+                "cpu_time": 950.2,
+                "peak_rss_mb": 310.4,
+                "peak_children_rss_mb": 2950.7,
+                "files": 8,
+                "audio_seconds": 7200.0,
+                "rtf": 0.017
+            }
+        ],
+        "files": [
+            {
+                "stage": "asr",
+                "file": "data/input/file1.wav",
+                "wall_time": 60.1,
+                "cpu_time": 59.8,
+                "audio_seconds": 900.0,
+                "rtf": 0.067
+            }
+        ]
+    }
+    """
+
+    def __init__(self, profile_dir=None):
+        """
+        :param profile_dir: folder for cProfile dumps of every stage (<stage>.prof), None to disable
+        """
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.files = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        n_files = len(self.files)
+        profile = None
+        if self.profile_dir is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        start_time, start_cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            wall_time, cpu = time.time() - start_time, cpu_time() - start_cpu
+            if profile is not None:
+                profile.disable()
+                if not os.path.exists(self.profile_dir):
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(self.profile_dir, '%s.prof' % name))
+
+            files = self.files[n_files:]
+            audio_seconds = sum([f['audio_seconds'] for f in files if f['audio_seconds'] is not None])
+            rss, children_rss = peak_rss()
+            self.stages.append({
+                'stage': name,
+                'wall_time': wall_time,
+                'cpu_time': cpu,
+                'peak_rss_mb': rss,
+                'peak_children_rss_mb': children_rss,
+                'files': len(files),
+                'audio_seconds': audio_seconds,
+                'rtf': real_time_factor(wall_time, audio_seconds),
+            })
+            print('%s: %.1f sec, cpu %.1f sec, %d files, %.1f sec of audio'
+                  % (name, wall_time, cpu, len(files), audio_seconds))
+
+    def add_file(self, stage, path, wall_time, cpu, audio_seconds=None):
+        """
+        Record one processed file (may be called from the stage or with timings returned by worker processes)
+        """
+        self.files.append({
+            'stage': stage,
+            'file': path,
+            'wall_time': wall_time,
+            'cpu_time': cpu,
+            'audio_seconds': audio_seconds,
+            'rtf': real_time_factor(wall_time, audio_seconds),
+        })
+
+    def save(self, json_path, csv_path):
+        """
+        Write report in .json format and the same records as one .csv table (stage rows have empty file)
+        """
+        dir_name = os.path.dirname(json_path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        with open(json_path, 'w') as f:
+            json.dump({'stages': self.stages, 'files': self.files}, f, indent=4, ensure_ascii=False)
+
+        fields = ['stage', 'file', 'wall_time', 'cpu_time', 'peak_rss_mb', 'peak_children_rss_mb',
+                  'files', 'audio_seconds', 'rtf']
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.stages + self.files)
@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+
+
+"""
+Framewise audio quality metrics are stored in .npz format:
+
+    energy - float32 array with dBFS of every frame
+    snr - float32 array with estimated SNR of every frame (dB): energy above the noise floor of its block,
+          the noise floor is the 10th percentile of frame energies in a block
+    clipping - float32 array with the fraction of samples of every frame at full scale
+    flatness - float32 array with spectral flatness of every frame (geometric mean / arithmetic mean
+               of the power spectrum): ~0 for tones and voiced speech, ~0.5 for white noise
+    frame_length - number of audio frames (samples) in one metrics frame
+"""
+
+MIN_DBFS = -120.0  # energy of digital silence
+CLIP_LEVEL = 32767 * 0.99  # samples at full scale are clipped
+NOISE_PERCENTILE = 10  # noise floor percentile of frame energies in a block
+
+
+def frame_metrics(samples, frame_rate, frame_duration=0.05, block_duration=5.0, batch_frames=1024):
+    """
+    Energy, estimated SNR, clipping and spectral flatness of every frame of audio
+
+    Frames are processed in batches of batch_frames, so memory does not grow with audio duration,
+    a partial frame in the end of audio is not measured
+
+    :param samples: np.array of np.int16 samples (from read_wav)
+    :param frame_rate: frame rate (Hz)
+    :param frame_duration: frame duration (sec)
+    :param block_duration: duration of blocks to estimate the noise floor (sec)
+    :return: dict of metrics (see above)
+    """
+    frame_length = max(int(round(frame_duration * frame_rate)), 1)
+    n_frames = len(samples) // frame_length
+    window = np.hanning(frame_length).astype(np.float32)
+
+    energy = np.empty(n_frames, dtype=np.float32)
+    clipping = np.empty(n_frames, dtype=np.float32)
+    flatness = np.empty(n_frames, dtype=np.float32)
+    for i in range(0, n_frames, batch_frames):
+        n = min(batch_frames, n_frames - i)
+        frames = np.asarray(samples[i * frame_length:(i + n) * frame_length], dtype=np.float32)
+        frames = frames.reshape(n, frame_length)
+
+        rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+        with np.errstate(divide='ignore'):
+            energy[i:i + n] = np.maximum(20 * np.log10(rms / 32768), MIN_DBFS)
+        clipping[i:i + n] = np.mean(np.abs(frames) >= CLIP_LEVEL, axis=1)
+
+        power = np.square(np.abs(np.fft.rfft(frames * window, axis=1))) + 1e-10
+        flatness[i:i + n] = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+
+    # noise floor of every block, the last block may be partial
+    block_length = max(int(round(block_duration / frame_duration)), 1)
+    n_blocks = -(-n_frames // block_length)
+    blocks = np.full(n_blocks * block_length, np.nan, dtype=np.float32)
+    blocks[:n_frames] = energy
+    if n_blocks:
+        noise_floor = np.nanpercentile(blocks.reshape(n_blocks, block_length), NOISE_PERCENTILE, axis=1)
+    else:
+        noise_floor = np.empty(0, dtype=np.float32)
+    snr = energy - np.repeat(noise_floor, block_length)[:n_frames].astype(np.float32)
+
+    return {'energy': energy, 'snr': snr, 'clipping': clipping, 'flatness': flatness,
+            'frame_length': frame_length}
+
+
+def bad_frames(metrics, min_snr, max_clipping, max_flatness, silence_threshold):
+    """
+    Frames not worth recognizing: close to the noise floor (pauses, noise and music beds), clipped,
+    or noise-like (flat spectrum) and louder than silence_threshold (dBFS)
+
+    :return: boolean np.array
+    """
+    return (metrics['snr'] < min_snr) | (metrics['clipping'] > max_clipping) \
+        | ((metrics['energy'] > silence_threshold) & (metrics['flatness'] > max_flatness))
+
+
+def skip_regions(bad, frame_length, min_skip, pad):
+    """
+    Runs of bad frames longer than min_skip + 2 * pad frames shortened by pad frames on both sides
+
+    Short runs (fricatives, pauses between words) are not skipped, the pad keeps the edges of words
+    next to a skipped region
+
+    :param bad: boolean np.array of bad frames (from bad_frames)
+    :param frame_length: number of audio frames in one metrics frame
+    :param min_skip: minimal run of skipped metrics frames
+    :param pad: metrics frames kept on both sides of a run
+    :return: list of (begin, end) skipped audio frames
+    """
+    edges = np.diff(np.concatenate([[0], bad.astype(np.int8), [0]]))
+    begins, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    long_runs = ends - begins >= min_skip + 2 * pad
+    return [(int(begin + pad) * frame_length, int(end - pad) * frame_length)
+            for begin, end in zip(begins[long_runs], ends[long_runs])]
+
+
+def keep_regions(skipped, n_frames):
+    """
+    Audio frames between skipped regions
+
+    :param skipped: sorted list of (begin, end) skipped audio frames (from skip_regions)
+    :param n_frames: number of audio frames
+    :return: list of (begin, end) kept audio frames
+    """
+    bounds = [0] + [position for region in skipped for position in region] + [n_frames]
+    return [(begin, end) for begin, end in zip(bounds[::2], bounds[1::2]) if end > begin]
+
+
+def clip_quality(metrics, frame_rate, start, end):
+    """
+    Quality of a clip of audio: mean SNR (dB), fraction of clipped samples and mean spectral flatness
+    of metrics frames between start and end (sec), None if the clip is shorter than one frame
+    """
+    frame_duration = metrics['frame_length'] / frame_rate
+    begin = int(start / frame_duration)
+    stop = max(int(np.ceil(end / frame_duration)), begin + 1)
+    if begin >= len(metrics['energy']):
+        return None, None, None
+    return (float(np.mean(metrics['snr'][begin:stop])), float(np.mean(metrics['clipping'][begin:stop])),
+            float(np.mean(metrics['flatness'][begin:stop])))
+
+
+def save_metrics(path, metrics):
+    """
+    Write metrics to .npz file (written to a temporary file and renamed)
+    """
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **metrics)
+    os.replace(tmp_path, path)
+
+
+def load_metrics(path):
+    with np.load(path) as npz:
+        metrics = {key: npz[key] for key in ['energy', 'snr', 'clipping', 'flatness']}
+        metrics['frame_length'] = int(npz['frame_length'])
+    return metrics
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+def fragment_ranges(columns, min_conf):
+    """
+    Words of recognized fragments which are kept without segmentation: not empty fragments
+    with confidence of every word >= min_conf
+
+    :param columns: text fragments as columns (see utils.transcripts)
+    :return: list of (first word, last word, text), text is None if it is the joined words
+    """
+    offsets = columns['offsets']
+    nonempty = offsets[1:] > offsets[:-1]
+    if columns['texts'] is not None:
+        nonempty &= np.array(columns['texts'], dtype=object) != ''
+    # words of fragments are contiguous
+    first, last = offsets[:-1][nonempty], offsets[1:][nonempty] - 1
+    if len(first) == 0:
+        return []
+    keep = np.minimum.reduceat(columns['conf'], first) >= min_conf
+    texts = np.array(columns['texts'], dtype=object)[nonempty][keep].tolist() if columns['texts'] is not None \
+        else [None] * int(keep.sum())
+    return list(zip(first[keep].tolist(), last[keep].tolist(), texts))
+
+
+def segment_words(columns, min_span, max_span, min_conf, max_gap=1.0, min_split_gap=0.1):
+    """
+    Segment recognized words into samples with duration between min_span and max_span
+
+    1. fragments are split at words with confidence < min_conf (the words are dropped)
+    2. pieces longer than max_span are split at the largest pause between words (>= min_split_gap),
+       pauses giving both parts longer than min_span are preferred
+    3. adjacent pieces are merged if one of them is shorter than min_span, the pause between them
+       is <= max_gap and the merged piece is not longer than max_span
+
+    Duration of a piece is the time from the start of its first word to the end of its last word
+
+    :param columns: text fragments as columns (see utils.transcripts)
+    :return: list of (first word, last word, text), text is None if it is the joined words
+    """
+    start, end, conf = columns['start'], columns['end'], columns['conf']
+    offsets = columns['offsets'].tolist()
+    texts = columns['texts']
+
+    # 1. runs of confident words inside every fragment
+    pieces = []
+    for i, (begin, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if begin == stop or (texts is not None and texts[i] == ''):
+            continue
+        good = np.flatnonzero(conf[begin:stop] >= min_conf) + begin
+        if len(good) == 0:
+            continue
+        # split good words into runs of consecutive indices
+        breaks = np.flatnonzero(np.diff(good) > 1) + 1
+        for run in np.split(good, breaks):
+            whole = run[0] == begin and run[-1] == stop - 1
+            pieces.append((int(run[0]), int(run[-1]), texts[i] if whole and texts is not None else None))
+
+    # 2. split long pieces
+    def split(first, last, text):
+        if end[last] - start[first] <= max_span or first == last:
+            return [(first, last, text)]
+        gaps = start[first + 1:last + 1] - end[first:last]
+        candidates = np.flatnonzero(gaps >= min_split_gap)
+        if len(candidates) == 0:
+            return [(first, last, text)]
+        balanced = [k for k in candidates if end[first + k] - start[first] >= min_span
+                    and end[last] - start[first + k + 1] >= min_span]
+        k = max(balanced if balanced else candidates, key=lambda k: gaps[k])
+        return split(first, first + k, None) + split(first + k + 1, last, None)
+
+    pieces = [segment for piece in pieces for segment in split(*piece)]
+
+    # 3. merge short neighbours
+    segments = []
+    for first, last, text in pieces:
+        if segments:
+            prev_first, prev_last, _ = segments[-1]
+            prev_span = end[prev_last] - start[prev_first]
+            span = end[last] - start[first]
+            if prev_last + 1 == first and (prev_span < min_span or span < min_span) \
+                    and start[first] - end[prev_last] <= max_gap and end[last] - start[prev_first] <= max_span:
+                segments[-1] = (prev_first, last, None)
+                continue
+        segments.append((first, last, text))
+    return segments
+
+
+def speech_duration(columns, segments):
+    """
+    Duration of words of segments (sec), pauses between words are not counted
+    """
+    durations = np.concatenate([[0.0], np.cumsum(columns['end'] - columns['start'])])
+    return float(sum([durations[last + 1] - durations[first] for first, last, _ in segments]))
+
+
+def segments_yield(columns, segments, min_span, max_span):
+    """
+    Estimate of the transcribed speech kept in the dataset by word times
+
+    :param segments: list of (first word, last word, text) (from fragment_ranges or segment_words)
+    :return: speech of segments with duration between min_span and max_span (sec), all transcribed speech (sec)
+    """
+    start, end = columns['start'], columns['end']
+    kept = [(first, last, text) for first, last, text in segments if min_span < end[last] - start[first] < max_span]
+    return speech_duration(columns, kept), float(np.sum(end - start))
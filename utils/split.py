@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def split_by_duration(durations, fractions, groups=None, seed=0):
+    """
+    Split clips into subsets (e.g. train, val, test) with the given fractions of the total audio duration
+
+    With groups all clips of a group (e.g. of one source audio file) are put into one subset, so clips
+    of the same recording never leak between subsets: first every subset with a fraction gets one of the smallest
+    groups (the smallest subset first), so a small subset (e.g. 5% val) is not left empty by larger groups,
+    then the other groups are taken in random order and every group goes to the subset which is the most behind
+    its target duration. With fewer groups than subsets the smallest subsets are empty.
+    Without groups clips are shuffled and cut by cumulative duration
+
+    The split is deterministic for a given seed
+
+    :param durations: duration of every clip (sec)
+    :param fractions: fraction of the total duration of every subset
+    :param groups: integer group code of every clip (e.g. from pandas.factorize), None to split clips
+    :param seed: random seed
+    :return: np.array with subset index of every clip
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    fractions = np.asarray(fractions, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    if len(durations) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if groups is None:
+        order = rng.permutation(len(durations))
+        ends = np.cumsum(durations[order])
+        # a clip belongs to the subset containing its middle
+        bounds = np.cumsum(fractions)[:-1] / np.sum(fractions) * ends[-1]
+        subsets = np.empty(len(durations), dtype=np.int64)
+        subsets[order] = np.searchsorted(bounds, ends - durations[order] / 2, side='right')
+        return subsets
+
+    groups = np.asarray(groups)
+    group_durations = np.bincount(groups, weights=durations)
+    targets = fractions / np.sum(fractions) * np.sum(group_durations)
+    assigned = np.zeros(len(fractions))
+    group_subsets = np.zeros(len(group_durations), dtype=np.int64)
+    order = rng.permutation(len(group_durations))
+
+    # equal groups are seeded in random order
+    smallest = order[np.argsort(group_durations[order], kind='stable')].tolist()
+    seeds = [subset for subset in np.argsort(fractions, kind='stable').tolist() if fractions[subset] > 0]
+    seeds = seeds[max(len(seeds) - len(group_durations), 0):]
+    for subset, group in zip(seeds, smallest):
+        assigned[subset] += group_durations[group]
+        group_subsets[group] = subset
+    seeded = set(smallest[:len(seeds)])
+
+    for group in order.tolist():
+        if group in seeded:
+            continue
+        subset = int(np.argmax(np.where(fractions > 0, targets - assigned, -np.inf)))
+        assigned[subset] += group_durations[group]
+        group_subsets[group] = subset
+    return group_subsets[groups]
@@ -4,45 +4,58 @@ import re
 def russian_cleaner(txt):
     # required
     txt = txt.lower()
-    txt = re.sub('ё', 'е', txt)
+    txt = txt.replace('ё', 'е')
     # optional
-    txt = re.sub('"', '', txt)
+    txt = txt.replace('"', '')
     return txt
 
 
+# abbreviations
+# https://keithito.com/LJ-Speech-Dataset/
+_english_abbreviations = {
+    "Mr.": "Mister",
+    "Mrs.": "Misses",  # Misess (*)
+    "Dr.": "Doctor",
+    # "No.": "Number",
+    "St.": "Saint",
+    # "Co.": "Company",
+    # "Jr.": "Junior",
+    # "Maj.": "Major",
+    # "Gen.": "General",
+    # "Drs.": "Doctors",
+    # "Rev.": "Reverend",
+    # "Lt.": "Lieutenant",
+    # "Hon.": "Honorable",
+    # "Sgt.": "Sergeant",
+    # "Capt.": "Captain",
+    # "Esq.": "Esquire",
+    # "Ltd.": "Limited",
+    # "Col.": "Colonel",
+    # "Ft.": "Fort"
+}
+# patterns are compiled once (abbreviations are regular expressions as before)
+_english_abbreviations_re = [(re.compile(abbr), ext) for abbr, ext in _english_abbreviations.items()]
+
+
 def english_cleaner(txt):
-    # abbreviations
-    # https://keithito.com/LJ-Speech-Dataset/
-    abbreviations = {
-        "Mr.": "Mister",
-        "Mrs.": "Misses",  # Misess (*)
-        "Dr.": "Doctor",
-        # "No.": "Number",
-        "St.": "Saint",
-        # "Co.": "Company",
-        # "Jr.": "Junior",
-        # "Maj.": "Major",
-        # "Gen.": "General",
-        # "Drs.": "Doctors",
-        # "Rev.": "Reverend",
-        # "Lt.": "Lieutenant",
-        # "Hon.": "Honorable",
-        # "Sgt.": "Sergeant",
-        # "Capt.": "Captain",
-        # "Esq.": "Esquire",
-        # "Ltd.": "Limited",
-        # "Col.": "Colonel",
-        # "Ft.": "Fort"
-    }
-    for abbr, ext in abbreviations.items():
-        txt = re.sub(abbr, ext, txt)
+    for abbr, ext in _english_abbreviations_re:
+        txt = abbr.sub(ext, txt)
     # required
     txt = txt.lower()
     # optional
-    txt = re.sub('"', '', txt)
+    txt = txt.replace('"', '')
     return txt
 
 
+def english_cleaner_series(texts):
+    """
+    english_cleaner for pandas.Series of texts
+    """
+    for abbr, ext in _english_abbreviations_re:
+        texts = texts.str.replace(abbr, ext, regex=True)
+    return texts.str.lower().str.replace('"', '', regex=False)
+
+
 def russian_restore_punc_cleaner(txt):
     txt = re.sub(' - ', '-', txt)
     txt = re.sub(' ! ', '! ', txt)
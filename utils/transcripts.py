@@ -0,0 +1,167 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+"""
+Text fragments of ASR and punctuation stages are stored in .json format (see models.SpeechToText)
+or in compact columnar .npz format:
+
+    start, end, conf - float64 arrays with values of every word
+    word_ids - int32 array with index of every word in vocabulary
+    vocabulary - utf-8 encoded distinct words separated by new lines (uint8 array)
+    offsets - int64 array with index of the first word of every fragment and the total number of words
+    texts - utf-8 encoded texts of fragments separated by new lines (only if a text is not equal to its joined words)
+
+Times and confidences keep float64, so .json -> .npz -> .json conversion is lossless
+and samples are cut at the same frames
+"""
+
+
+def obj_dict(obj):
+    return obj.__dict__
+
+
+def transcript_to_columns(data):
+    """
+    Convert .json data to columns
+
+    :param data: list of text fragments
+    :return: dict of columns
+    """
+    words = [word for item in data for word in item.get('result', [])]
+    vocabulary = {}
+    word_ids = np.array([vocabulary.setdefault(word['word'], len(vocabulary)) for word in words], dtype=np.int32)
+
+    texts = [item['text'] for item in data]
+    joined = all([text == ' '.join([word['word'] for word in item.get('result', [])])
+                  for text, item in zip(texts, data)])
+
+    return {
+        'start': np.array([word['start'] for word in words], dtype=np.float64),
+        'end': np.array([word['end'] for word in words], dtype=np.float64),
+        'conf': np.array([word['conf'] for word in words], dtype=np.float64),
+        'word_ids': word_ids,
+        'vocabulary': list(vocabulary),
+        'offsets': np.cumsum([0] + [len(item.get('result', [])) for item in data], dtype=np.int64),
+        'texts': None if joined else texts,
+    }
+
+
+def columns_to_transcript(columns):
+    """
+    Convert columns to .json data
+
+    :param columns: dict of columns
+    :return: list of text fragments
+    """
+    vocabulary = columns['vocabulary']
+    start = columns['start'].tolist()
+    end = columns['end'].tolist()
+    conf = columns['conf'].tolist()
+    words = [vocabulary[i] for i in columns['word_ids'].tolist()]
+    offsets = columns['offsets'].tolist()
+
+    data = []
+    for i, (begin, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        text = columns['texts'][i] if columns['texts'] is not None else ' '.join(words[begin:stop])
+        if begin == stop:
+            data.append({'text': text})
+        else:
+            data.append({
+                'result': [{'conf': conf[j], 'end': end[j], 'start': start[j], 'word': words[j]}
+                           for j in range(begin, stop)],
+                'text': text,
+            })
+    return data
+
+
+def _encode(strings):
+    return np.frombuffer('\n'.join(strings).encode('utf8'), dtype=np.uint8)
+
+
+def _decode(array):
+    return array.tobytes().decode('utf8').split('\n')
+
+
+def save_columns(path, columns):
+    arrays = {key: columns[key] for key in ['start', 'end', 'conf', 'word_ids', 'offsets']}
+    arrays['vocabulary'] = _encode(columns['vocabulary'])
+    if columns['texts'] is not None:
+        arrays['texts'] = _encode(columns['texts'])
+    np.savez_compressed(path, **arrays)
+
+
+def load_columns(path):
+    """
+    Read text fragments of .json or .npz file as columns
+    """
+    if not path.endswith('.npz'):
+        with open(path, encoding='utf8') as f:
+            return transcript_to_columns(json.load(f))
+
+    with np.load(path) as npz:
+        columns = {key: npz[key] for key in ['start', 'end', 'conf', 'word_ids', 'offsets']}
+        columns['vocabulary'] = _decode(npz['vocabulary'])
+        columns['texts'] = _decode(npz['texts']) if 'texts' in npz.files else None
+    if len(columns['word_ids']) == 0:
+        columns['vocabulary'] = []
+    return columns
+
+
+def save_transcript(path, data):
+    """
+    Write text fragments to .json or .npz file (by extension)
+
+    The file is written to a temporary file and renamed when complete
+    """
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name, exist_ok=True)
+
+    tmp_path = path + '.tmp'
+    if path.endswith('.npz'):
+        # written to file object, np.savez would add .npz extension to the file name
+        with open(tmp_path, 'wb') as f:
+            save_columns(f, transcript_to_columns(data))
+    else:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, default=obj_dict, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_transcript(path):
+    """
+    Read text fragments from .json or .npz file (by extension)
+    """
+    if path.endswith('.npz'):
+        return columns_to_transcript(load_columns(path))
+
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def convert_transcripts(src_dir, des_dir, file_format):
+    """
+    Convert all text fragment files of src_dir to file_format ('json' or 'npz') keeping the folder structure
+    """
+    assert file_format in ['json', 'npz']
+
+    for root, _, files in os.walk(src_dir):
+        for name in sorted(files):
+            if os.path.splitext(name)[1] not in ['.json', '.npz']:
+                continue
+            src = os.path.join(root, name)
+            local_path = os.path.splitext(os.path.relpath(src, src_dir))[0] + '.' + file_format
+            save_transcript(os.path.join(des_dir, local_path), load_transcript(src))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert text fragment files between .json and .npz formats')
+    parser.add_argument('src_dir', help='folder with .json or .npz files (e.g. data/asr)')
+    parser.add_argument('des_dir', help='output folder')
+    parser.add_argument('format', choices=['json', 'npz'], help='output format')
+    args = parser.parse_args()
+    convert_transcripts(args.src_dir, args.des_dir, args.format)
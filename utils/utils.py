@@ -1,12 +1,53 @@
 import os
 import re
 import glob
+import json
+import math
 import wave
+import hashlib
 import contextlib
-import pandas as pd
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 
+def parallel_map(func, tasks, workers=1, initializer=None, initargs=(), threads=False):
+    """
+    Apply func to every task in a pool of worker processes pulling tasks from a shared queue
+
+    Results are yielded in the order of tasks. With workers <= 1 tasks are processed in the current process
+
+    :param func: function of one argument (must be importable by worker processes)
+    :param tasks: iterable of arguments
+    :param workers: number of worker processes
+    :param initializer: function called once in every worker before processing tasks
+    :param initargs: arguments for initializer
+    :param threads: use worker threads instead of processes, at most 2 * workers tasks are submitted at once
+    """
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+
+    if threads:
+        with ThreadPoolExecutor(workers, initializer=initializer, initargs=initargs) as executor:
+            futures = collections.deque()
+            for task in tasks:
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+                futures.append(executor.submit(func, task))
+            while futures:
+                yield futures.popleft().result()
+        return
+
+    with multiprocessing.Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        for result in pool.imap(func, tasks, chunksize=1):
+            yield result
+
+
 def words_count(txt):
     txt = txt.lower()
     txt = re.sub('[,.!?]', '', txt)
@@ -17,11 +58,22 @@ def char_count(txt):
     return len(txt)
 
 
-def distinct_words_count(text_series):
-    text_series = text_series.apply(lambda x: re.sub('[,.!?]', '', x))
-    results = set()
-    text_series.str.lower().str.split().apply(results.update)
-    return len(results)
+def words_count_series(text_series):
+    """
+    words_count for pandas.Series of texts (punctuation removal and lower case do not change spaces)
+    """
+    return text_series.str.count(' ') + 1
+
+
+def char_count_series(text_series):
+    return text_series.str.len()
+
+
+def words_series(text_series):
+    """
+    Words of pandas.Series of texts (punctuation removed, lower case), one word per row with the index of its text
+    """
+    return text_series.str.replace('[,.!?]', '', regex=True).str.lower().str.split().explode().dropna()
 
 
 def format_time(time_sec):
@@ -35,7 +87,253 @@ def format_number(number):
     return f"{number:,}"
 
 
-def dataset_stat(audio_dir, metadata_dir, stat_dir):
+def wav_duration(path):
+    with contextlib.closing(wave.open(path, 'r')) as f:
+        return f.getnframes() / float(f.getframerate())
+
+
+class DatasetSummary:
+    """
+    Mergeable statistics of dataset clips: number of clips, total, min and max duration (sec) of audio
+    and number of texts, words, characters and count of every distinct word of text labels
+
+    Summaries of parts of a dataset (e.g. of every source audio file) are merged exactly as of the whole dataset
+    """
+
+    def __init__(self, clips=0, duration=0.0, min_duration=None, max_duration=None, texts=0, words=0, chars=0,
+                 vocabulary=None):
+        self.clips = clips
+        self.duration = duration
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.texts = texts
+        self.words = words
+        self.chars = chars
+        self.vocabulary = collections.Counter(vocabulary or {})
+
+    def update(self, durations=(), texts=()):
+        """
+        Add clips with durations (sec) and text labels, texts are counted with .str operations
+        """
+        import pandas as pd
+
+        durations = np.asarray(list(durations), dtype=np.float64)
+        texts = pd.Series(list(texts), dtype=object)
+        words = words_series(texts).value_counts()
+        summary = DatasetSummary(
+            clips=len(durations),
+            duration=float(np.sum(durations)) if len(durations) else 0.0,
+            min_duration=float(np.min(durations)) if len(durations) else None,
+            max_duration=float(np.max(durations)) if len(durations) else None,
+            texts=len(texts),
+            words=int(words_count_series(texts).sum()),
+            chars=int(char_count_series(texts).sum()),
+            vocabulary=dict(zip(words.index.tolist(), words.values.tolist())),
+        )
+        return self.merge(summary)
+
+    def merge(self, other):
+        self.clips += other.clips
+        self.duration += other.duration
+        self.min_duration = min([value for value in [self.min_duration, other.min_duration] if value is not None],
+                                default=None)
+        self.max_duration = max([value for value in [self.max_duration, other.max_duration] if value is not None],
+                                default=None)
+        self.texts += other.texts
+        self.words += other.words
+        self.chars += other.chars
+        self.vocabulary.update(other.vocabulary)
+        return self
+
+    def to_dict(self):
+        return {'clips': self.clips, 'duration': self.duration, 'min_duration': self.min_duration,
+                'max_duration': self.max_duration, 'texts': self.texts, 'words': self.words, 'chars': self.chars,
+                'vocabulary': dict(self.vocabulary)}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def differences(self, other, rel_tol=1e-9):
+        """
+        Names of statistics which differ from statistics of other summary
+        """
+        names = []
+        for name in ['clips', 'texts', 'words', 'chars']:
+            if getattr(self, name) != getattr(other, name):
+                names.append(name)
+        for name in ['duration', 'min_duration', 'max_duration']:
+            a, b = getattr(self, name), getattr(other, name)
+            if (a is None) != (b is None) or (a is not None and not math.isclose(a, b, rel_tol=rel_tol)):
+                names.append(name)
+        if +self.vocabulary != +other.vocabulary:
+            names.append('vocabulary')
+        return names
+
+    def write(self, stat_dir):
+        """
+        Write statistics in LJSpeech format (see dataset_stat)
+        """
+        with contextlib.closing(open(stat_dir, 'w')) as stat_file:
+            print("Total Clips", format_number(self.clips), file=stat_file)
+            print("Total Words", format_number(self.words), file=stat_file)
+            print("Total Characters", format_number(self.chars), file=stat_file)
+            print("Total Duration", format_time(self.duration), file=stat_file)
+            print("Mean Clip Duration", "%.2f" % (self.duration / self.clips if self.clips else 0.0), "sec",
+                  file=stat_file)
+            print("Min Clip Duration", "%.2f" % (self.min_duration or 0.0), "sec", file=stat_file)
+            print("Max Clip Duration", "%.2f" % (self.max_duration or 0.0), "sec", file=stat_file)
+            print("Mean Words per Clip", "%.2f" % (self.words / self.texts if self.texts else 0.0), file=stat_file)
+            print("Distinct Words", format_number(len(+self.vocabulary)), file=stat_file)
+
+
+def source_summaries(sources, durations, texts):
+    """
+    DatasetSummary of clips of every source audio file
+
+    Words, characters and vocabulary of texts of all sources are counted at once with .str operations
+    and summed by source
+
+    :param sources: pandas.Series with source of every clip
+    :param durations: pandas.Series with duration of every clip (sec)
+    :param texts: pandas.Series with text label of every clip
+    :return: {source: DatasetSummary}
+    """
+    import pandas as pd
+
+    texts = pd.Series(texts.values, dtype=object)
+    clips = pd.DataFrame({'source': sources.values, 'duration': np.asarray(durations.values, dtype=np.float64),
+                          'words': words_count_series(texts).values, 'chars': char_count_series(texts).values})
+    totals = clips.groupby('source', sort=False).agg(
+        clips=('duration', 'size'), duration=('duration', 'sum'), min_duration=('duration', 'min'),
+        max_duration=('duration', 'max'), words=('words', 'sum'), chars=('chars', 'sum'))
+    summaries = {source: DatasetSummary(int(row.clips), float(row.duration), float(row.min_duration),
+                                        float(row.max_duration), int(row.clips), int(row.words), int(row.chars))
+                 for source, row in zip(totals.index.tolist(), totals.itertuples())}
+
+    words = words_series(texts)
+    counts = pd.DataFrame({'source': sources.values[words.index.values], 'word': words.values}).value_counts(sort=False)
+    for (source, word), count in zip(counts.index.tolist(), counts.values.tolist()):
+        summaries[source].vocabulary[word] = count
+    return summaries
+
+
+class DatasetStats:
+    """
+    Persisted dataset statistics accumulated by source audio files
+
+    Every source keeps the fingerprint of its clips and their DatasetSummary. Only summaries of new or changed
+    sources are computed and their vocabulary is added to the total one, counts and durations of the total
+    are summed over the per-source summaries, so clips of unchanged sources are never read again
+
+    Statistics in .json format
+    {
+        "total": {"clips": 2, "duration": 7.5, ..., "vocabulary": {"hello": 2, "world": 1}},
+        "sources": {
+            "data/input/file1.wav": {
+                "fingerprint": "da39a3ee5e6b4b0d3255bfef95601890afd80709",
+                "summary": {"clips": 2, "duration": 7.5, ..., "vocabulary": {"hello": 2, "world": 1}}
+            }
+        }
+    }
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.total = DatasetSummary()
+        self.sources = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                data = json.load(f)
+            self.total = DatasetSummary.from_dict(data['total'])
+            self.sources = {source: {'fingerprint': entry['fingerprint'],
+                                     'summary': DatasetSummary.from_dict(entry['summary'])}
+                            for source, entry in data['sources'].items()}
+
+    def update(self, sources, durations, texts):
+        """
+        Set clips of sources, summaries are recomputed only for sources whose durations or texts have changed
+        (all at once, see source_summaries)
+
+        Clip names are not fingerprinted: they are numbered by source order, so adding a source renames
+        the clips of the following sources without changing their statistics
+
+        :param sources: pandas.Series with source of every clip
+        :param durations: pandas.Series with duration of every clip (sec)
+        :param texts: pandas.Series with text label of every clip
+        :return: list of sources whose summaries were recomputed
+        """
+        fingerprints = collections.OrderedDict()
+        for source, duration, text in zip(sources.tolist(), durations.tolist(), texts.tolist()):
+            if source not in fingerprints:
+                fingerprints[source] = hashlib.sha1()
+            fingerprints[source].update(('%r|%s\n' % (float(duration), text)).encode('utf8'))
+        changed = [source for source, sha1 in fingerprints.items()
+                   if source not in self.sources or self.sources[source]['fingerprint'] != sha1.hexdigest()]
+        if not changed:
+            return changed
+
+        mask = sources.isin(changed).values
+        summaries = source_summaries(sources[mask], durations[mask], texts[mask])
+        for source in changed:
+            self._remove(source)
+            self.sources[source] = {'fingerprint': fingerprints[source].hexdigest(), 'summary': summaries[source]}
+            self.total.vocabulary.update(summaries[source].vocabulary)
+        self._refresh()
+        return changed
+
+    def prune(self, sources):
+        """
+        Remove statistics of sources which are not in sources
+        """
+        sources = set(sources)
+        for source in [source for source in self.sources if source not in sources]:
+            self._remove(source)
+        self._refresh()
+
+    def _remove(self, source):
+        entry = self.sources.pop(source, None)
+        if entry is not None:
+            self.total.vocabulary.subtract(entry['summary'].vocabulary)
+            self.total.vocabulary = +self.total.vocabulary
+
+    def _refresh(self):
+        # counts and durations are summed over sources again (no drift of float sums), vocabulary is kept
+        vocabulary = self.total.vocabulary
+        self.total = DatasetSummary()
+        for entry in self.sources.values():
+            summary = entry['summary']
+            self.total.merge(DatasetSummary(summary.clips, summary.duration, summary.min_duration,
+                                            summary.max_duration, summary.texts, summary.words, summary.chars))
+        self.total.vocabulary = vocabulary
+
+    def save(self):
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'total': self.total.to_dict(),
+                       'sources': {source: {'fingerprint': entry['fingerprint'], 'summary': entry['summary'].to_dict()}
+                                   for source, entry in self.sources.items()}}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def scan_dataset(audio_dir, metadata_dir):
+    """
+    DatasetSummary recomputed from disk: durations of all .wav files of audio_dir and text labels of metadata
+    """
+    import pandas as pd
+
+    audio_paths = glob.glob(os.path.join(audio_dir, '*.wav'))
+    sample_durations = [wav_duration(path) for path in audio_paths]
+
+    metadata = pd.read_csv(metadata_dir, sep='|', header=None, keep_default_na=False)
+    return DatasetSummary().update(sample_durations, metadata[1].astype(str).tolist())
+
+
+def dataset_stat(audio_dir, metadata_dir, stat_dir, summary=None):
     """
     Total Clips	        13,100
     Total Words	        225,715
@@ -46,37 +344,9 @@ def dataset_stat(audio_dir, metadata_dir, stat_dir):
     Max Clip Duration	10.10 sec
     Mean Words per Clip	17.23
     Distinct Words	    13,821
+
+    :param summary: DatasetSummary of the dataset (e.g. DatasetStats.total), recomputed from disk if None
     """
-    audio_paths = glob.glob(os.path.join(audio_dir, '*.wav'))
-    sample_durations = []
-    for path in audio_paths:
-        with contextlib.closing(wave.open(path, 'r')) as f:
-            frames = f.getnframes()
-            rate = f.getframerate()
-            duration = frames / float(rate)
-            sample_durations.append(duration)
-
-    metadata = pd.read_csv(metadata_dir, sep='|', header=None)
-    metadata['words'] = metadata[1].apply(words_count)
-    metadata['chars'] = metadata[1].apply(char_count)
-
-    total_clips = len(audio_paths)
-    total_words = np.sum(metadata['words'].values)
-    total_characters = np.sum(metadata['chars'].values)
-    total_duration = np.sum(sample_durations)
-    mean_clip_duration = np.mean(sample_durations)
-    min_clip_duration = np.min(sample_durations)
-    max_lip_duration = np.max(sample_durations)
-    mean_words_per_clip = np.mean(metadata['words'].values)
-    distinct_words = distinct_words_count(metadata[1])
-
-    with contextlib.closing(open(stat_dir, 'w')) as stat_file:
-        print("Total Clips", format_number(total_clips), file=stat_file)
-        print("Total Words", format_number(total_words), file=stat_file)
-        print("Total Characters", format_number(total_characters), file=stat_file)
-        print("Total Duration", format_time(total_duration), file=stat_file)
-        print("Mean Clip Duration", "%.2f" % mean_clip_duration, "sec", file=stat_file)
-        print("Min Clip Duration", "%.2f" % min_clip_duration, "sec", file=stat_file)
-        print("Max Clip Duration", "%.2f" % max_lip_duration, "sec", file=stat_file)
-        print("Mean Words per Clip", "%.2f" % mean_words_per_clip, file=stat_file)
-        print("Distinct Words", format_number(distinct_words), file=stat_file)
+    if summary is None:
+        summary = scan_dataset(audio_dir, metadata_dir)
+    summary.write(stat_dir)